@@ -7,10 +7,17 @@ from tqdm import tqdm
 import string
 import sqlite3
 import argparse
+import collections
+import heapq
+import itertools
+import multiprocessing
 import sys
 import re
 import Levenshtein as matching
 
+from rb_crawler.instrumentation import instrumented, iterate, span, trace
+from trigram_index import TrigramIndex
+
 SELECT_COUNT = \
 '''SELECT COUNT(*) FROM ({})'''
 
@@ -53,10 +60,11 @@ DROP_RB_LEI = \
 CREATE_RB_LEI = \
 '''CREATE TABLE `rb-lei`
        (id INTEGER,
-        lei TEXT)'''
+        lei TEXT,
+        score REAL)'''
 
 INSERT_RB_LEI = \
-'''INSERT INTO `rb-lei` VALUES (?, ?)'''
+'''INSERT INTO `rb-lei` VALUES (?, ?, ?)'''
 
 def temporary_LEI(connection):
     no_postal = 0
@@ -114,7 +122,14 @@ def better_edit_distance_one_direction(a, b):
     return diff
 
 def better_edit_distance(a, b):
-    return min(better_edit_distance_one_direction(a, b), better_edit_distance_one_direction(a, b))
+    # editops is only computed once, a second call with the same arguments cannot change the minimum
+    return better_edit_distance_one_direction(a, b)
+
+def normalized_key(name, postal):
+    # Names match if they are equal after removing all characters other than ASCII letters and digits. This is
+    # intentionally stricter than a distance of 0 in better_edit_distance, which only counts the destination character
+    # of a replacement, so it also ignores letters or digits replaced by other characters (e.g. "Fooa" and "Foo-")
+    return postal, ''.join(char for char in name if char in BAD_CHARACTERS)
 
 def match_join(connection):
     matches = 0
@@ -128,20 +143,202 @@ def match_join(connection):
     for row in tqdm(rows, total=num_rows, desc='Fuzzy matching company names'):
         dist = better_edit_distance(row[2], row[3])
         if dist == 0:
-            insert_cursor.execute(INSERT_RB_LEI, (row[0], row[1]))
+            insert_cursor.execute(INSERT_RB_LEI, (row[0], row[1], 1.0))
             matches += 1
     print(f'{matches} matches found between RB and LEI company names', file=sys.stderr)
 
+def match_hash(connection):
+    postal_regex = re.compile('[0-9]{5}')
+
+    connection.execute(DROP_RB_LEI)
+    connection.execute(CREATE_RB_LEI)
+
+    lei_by_key = {}
+    with span('index'):
+        num_rows = connection.execute(SELECT_COUNT.format(SELECT_LEI)).fetchone()[0]
+        lei_rows = iterate('read', connection.execute(SELECT_LEI))
+        for lei, name, address in tqdm(lei_rows, total=num_rows, desc='Indexing LEI'):
+            if name is None or address is None or (postal := postal_regex.search(address)) is None:
+                continue
+            lei_by_key.setdefault(normalized_key(name, postal.group()), []).append(lei)
+
+    def matching_pairs():
+        num_rows = connection.execute(SELECT_COUNT.format(SELECT_RB)).fetchone()[0]
+        rb_rows = iterate('read', connection.execute(SELECT_RB))
+        for id, name, address in tqdm(rb_rows, total=num_rows, desc='Matching RB'):
+            if name is None or address is None or (postal := postal_regex.search(address)) is None:
+                continue
+            for lei in lei_by_key.get(normalized_key(name, postal.group()), []):
+                yield id, lei, 1.0
+
+    # Matching and writing are interleaved by executemany
+    with span('match') as match:
+        matches = match.rows = connection.cursor().executemany(INSERT_RB_LEI, matching_pairs()).rowcount
+    print(f'{matches} matches found between RB and LEI company names', file=sys.stderr)
+
+def map_bounded(pool, func, tasks, workers):
+    # Like pool.imap, but tasks are consumed in the calling thread, as sqlite cursors cannot be used from the pool's
+    # task handler thread. At most two tasks per worker are in flight, results are yielded in order.
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        while len(pending) > 2 * workers or (pending and pending[0].ready()):
+            yield pending.popleft().get()
+    for result in pending:
+        yield result.get()
+
+# Set in each worker process by the pool initializer
+fuzzy_index = None
+fuzzy_top_k = 1
+fuzzy_threshold = 0.0
+
+def init_fuzzy_worker(index, top_k, threshold):
+    global fuzzy_index, fuzzy_top_k, fuzzy_threshold
+    fuzzy_index, fuzzy_top_k, fuzzy_threshold = index, top_k, threshold
+
+def fuzzy_match_batch(batch):
+    results = []
+    for id, name, postal in batch:
+        for score, lei in fuzzy_index.query(name, fuzzy_top_k, fuzzy_threshold, block=postal):
+            results.append((id, lei, score))
+    return results
+
+def fuzzy_batches(connection, batch_size):
+    postal_regex = re.compile('[0-9]{5}')
+    num_rows = connection.execute(SELECT_COUNT.format(SELECT_RB)).fetchone()[0]
+    batch = []
+    rb_rows = iterate('read', connection.execute(SELECT_RB))
+    for id, name, address in tqdm(rb_rows, total=num_rows, desc='Fuzzy matching RB'):
+        if name is None or address is None or (postal := postal_regex.search(address)) is None:
+            continue
+        batch.append((id, name, postal.group()))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def match_fuzzy(connection, top_k=1, threshold=0.8, workers=None, batch_size=1000):
+    postal_regex = re.compile('[0-9]{5}')
+
+    def lei_documents():
+        num_rows = connection.execute(SELECT_COUNT.format(SELECT_LEI)).fetchone()[0]
+        lei_rows = iterate('read', connection.execute(SELECT_LEI))
+        for lei, name, address in tqdm(lei_rows, total=num_rows, desc='Indexing LEI'):
+            if name is None or address is None or (postal := postal_regex.search(address)) is None:
+                continue
+            yield lei, name, postal.group()
+
+    with span('index'):
+        index = TrigramIndex(lei_documents())
+    matches = []
+    workers = workers or multiprocessing.cpu_count()
+    # The RB companies are scored in the worker processes, this span only covers waiting for their results
+    with span('match'), \
+            multiprocessing.Pool(workers, initializer=init_fuzzy_worker, initargs=(index, top_k, threshold)) as pool:
+        for results in map_bounded(pool, fuzzy_match_batch, fuzzy_batches(connection, batch_size), workers):
+            matches.extend(results)
+    # Written only after scoring, so that the write transaction (and with it the lock the person deduplication may be
+    # waiting for, see pipeline.py) is held for the inserts only
+    with span('write', rows=len(matches)):
+        connection.execute(DROP_RB_LEI)
+        connection.execute(CREATE_RB_LEI)
+        connection.executemany(INSERT_RB_LEI, matches)
+    print(f'{len(matches)} matches found between RB and LEI company names', file=sys.stderr)
+
+SELECT_RB_PARTITIONED = \
+'''SELECT postalcode, id, name FROM `rb-temp` ORDER BY postalcode'''
+
+SELECT_LEI_PARTITIONED = \
+'''SELECT postalcode, lei, name FROM `lei-temp` ORDER BY postalcode'''
+
+def postal_code_partitions(connection):
+    # Merge join of both tables sorted by postal code, yielding (postal code, RB companies, LEI companies)
+    rb_rows = itertools.groupby(connection.execute(SELECT_RB_PARTITIONED), key=lambda row: row[0])
+    lei_rows = itertools.groupby(connection.execute(SELECT_LEI_PARTITIONED), key=lambda row: row[0])
+    rb_postal, rb_group = next(rb_rows, (None, None))
+    lei_postal, lei_group = next(lei_rows, (None, None))
+    while rb_postal is not None and lei_postal is not None:
+        if rb_postal < lei_postal:
+            rb_postal, rb_group = next(rb_rows, (None, None))
+        elif lei_postal < rb_postal:
+            lei_postal, lei_group = next(lei_rows, (None, None))
+        else:
+            yield rb_postal, [row[1:] for row in rb_group], [row[1:] for row in lei_group]
+            rb_postal, rb_group = next(rb_rows, (None, None))
+            lei_postal, lei_group = next(lei_rows, (None, None))
+
+def match_partition(partition):
+    postal, rb_companies, lei_companies = partition
+    matches = [
+        (id, lei, 1.0)
+        for id, rb_name in rb_companies
+        for lei, lei_name in lei_companies
+        if better_edit_distance(rb_name, lei_name) == 0
+    ]
+    return postal, len(rb_companies), len(lei_companies), matches
+
+def match_partitioned(connection, workers=None, report_partitions=10):
+    connection.execute(DROP_RB_LEI)
+    connection.execute(CREATE_RB_LEI)
+
+    matches = 0
+    partition_sizes = []
+    insert_cursor = connection.cursor()
+    workers = workers or multiprocessing.cpu_count()
+    with multiprocessing.Pool(workers) as pool:
+        partitions = tqdm(postal_code_partitions(connection), desc='Matching postal code partitions')
+        for postal, rb_size, lei_size, results in map_bounded(pool, match_partition, partitions, workers):
+            partition_sizes.append((rb_size * lei_size, postal, rb_size, lei_size))
+            insert_cursor.executemany(INSERT_RB_LEI, results)
+            matches += len(results)
+    print(f'{matches} matches found between RB and LEI company names', file=sys.stderr)
+
+    total_pairs = sum(pairs for pairs, *_ in partition_sizes)
+    print(f'{len(partition_sizes)} postal code partitions with {total_pairs} pairs, largest partitions:', file=sys.stderr)
+    for pairs, postal, rb_size, lei_size in heapq.nlargest(report_partitions, partition_sizes):
+        print(f'  {postal}: {rb_size} RB x {lei_size} LEI = {pairs} pairs ({pairs / max(total_pairs, 1):.1%})',
+              file=sys.stderr)
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Fuzzy match LEI relationship and RB companies')
     parser.add_argument('database', help='sqlite database to operate on')
+    parser.add_argument('--mode', choices=['hash', 'fuzzy', 'edit', 'partitioned'], default='hash',
+                        help='hash: single pass lookup of normalized names (default), '
+                             'fuzzy: top-k candidates of a trigram index with the same postal code, '
+                             'edit: edit distance of all companies with the same postal code, '
+                             'partitioned: like edit, but the postal codes are matched in parallel')
+    parser.add_argument('--top-k', type=int, default=1, help='fuzzy: number of LEI candidates per RB company')
+    parser.add_argument('--threshold', type=float, default=0.8, help='fuzzy: minimum cosine similarity of a match')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='fuzzy/partitioned: number of processes (default: all cores)')
+    parser.add_argument('--batch-size', type=int, default=1000, help='fuzzy: RB companies per batch')
+    parser.add_argument('--instrument', metavar='REPORT',
+                        help='write a report of spans and SQL timings to this JSON file')
+    parser.add_argument('--profile', help='write a sampling profile in folded format to this file')
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = parse_args()
-    conn = sqlite3.connect(args.database)
-    temporary_LEI(conn)
-    temporary_RB(conn)
-    match_join(conn)
-    conn.commit()
+    # Person deduplication may write to the same database concurrently (see pipeline.py), so wait for its locks.
+    # Transactions take the write lock when they begin, as one which already read cannot wait for another writer.
+    conn = sqlite3.connect(args.database, timeout=600, isolation_level='IMMEDIATE')
+    with instrumented(args.instrument, args.profile):
+        trace(conn)
+        if args.mode == 'hash':
+            match_hash(conn)
+        elif args.mode == 'fuzzy':
+            match_fuzzy(conn, args.top_k, args.threshold, args.workers, args.batch_size)
+        else:
+            with span('temporary_lei'):
+                temporary_LEI(conn)
+            with span('temporary_rb'):
+                temporary_RB(conn)
+            with span('match'):
+                if args.mode == 'partitioned':
+                    match_partitioned(conn, args.workers)
+                else:
+                    match_join(conn)
+        with span('commit'):
+            conn.commit()
 
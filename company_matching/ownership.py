@@ -0,0 +1,191 @@
+# Materializes the ownership graph of the RB companies matched to LEI records (see match.py)
+# 1. Map the LEI relationships to pairs of RB companies using `rb-lei`
+# 2. Build compressed sparse row (CSR) adjacency arrays of the graph
+# 3. Compute ultimate parent, depth and group (connected component) of every company once
+# 4. Persist the direct edges as `parents` and the results as `ownership`, both indexed
+
+from array import array
+from collections import deque
+from tqdm import tqdm
+import argparse
+import sqlite3
+import sys
+
+from rb_crawler.instrumentation import instrumented, span, trace
+
+SELECT_RB_LEI = \
+'''SELECT lei, id
+   FROM `rb-lei`
+   WHERE (lei, score) IN (SELECT lei, max(score) FROM `rb-lei` GROUP BY lei)'''
+
+SELECT_RELATIONSHIPS = \
+'''SELECT Relationship_StartNode_NodeID, Relationship_EndNode_NodeID, Relationship_RelationshipType
+   FROM `lei-relationship-data`
+   WHERE Relationship_RelationshipType IN ('IS_DIRECTLY_CONSOLIDATED_BY', 'IS_ULTIMATELY_CONSOLIDATED_BY')'''
+
+# Direct parents are preferred when following the chain to the ultimate parent
+RELATIONSHIP_RANK = {'IS_DIRECTLY_CONSOLIDATED_BY': 0, 'IS_ULTIMATELY_CONSOLIDATED_BY': 1}
+
+CREATE_PARENTS = \
+'''CREATE TABLE parents
+       (parent INTEGER,
+        child INTEGER,
+        FOREIGN KEY(parent) REFERENCES companies(id),
+        FOREIGN KEY(child) REFERENCES companies(id))'''
+
+CREATE_OWNERSHIP = \
+'''CREATE TABLE ownership
+       (company_id INTEGER PRIMARY KEY,
+        ultimate_parent INTEGER,
+        depth INTEGER,
+        group_id INTEGER,
+        group_size INTEGER,
+        FOREIGN KEY(company_id) REFERENCES companies(id),
+        FOREIGN KEY(ultimate_parent) REFERENCES companies(id))'''
+
+CREATE_INDEXES = [
+    'CREATE INDEX parents_parent ON parents(parent)',
+    'CREATE INDEX parents_child ON parents(child)',
+    'CREATE INDEX ownership_ultimate_parent ON ownership(ultimate_parent)',
+    'CREATE INDEX ownership_group_id ON ownership(group_id)',
+]
+
+UNKNOWN = -1
+
+def csr(num_nodes, edges):
+    '''Returns (offsets, targets), the targets of node i are targets[offsets[i]:offsets[i + 1]] in edge order.'''
+    offsets = array('I', [0]) * (num_nodes + 1)
+    for source, _ in edges:
+        offsets[source + 1] += 1
+    for i in range(num_nodes):
+        offsets[i + 1] += offsets[i]
+    targets = array('I', [0]) * len(edges)
+    position = offsets[:-1]
+    for source, target in edges:
+        targets[position[source]] = target
+        position[source] += 1
+    return offsets, targets
+
+class OwnershipGraph:
+    def __init__(self, company_edges):
+        '''company_edges: (child company id, parent company id, relationship rank) tuples'''
+        company_edges = sorted(set(company_edges), key=lambda edge: (edge[0], edge[2], edge[1]))
+        self.companies = array('q', sorted({company for edge in company_edges for company in edge[:2]}))
+        index = {company: i for i, company in enumerate(self.companies)}
+        edges = [(index[child], index[parent]) for child, parent, _ in company_edges if child != parent]
+        self.parent_offsets, self.parents = csr(len(self.companies), edges)
+        self.neighbour_offsets, self.neighbours = csr(
+            len(self.companies), edges + [(parent, child) for child, parent in edges]
+        )
+
+    def __len__(self):
+        return len(self.companies)
+
+    def ultimate_parents(self):
+        '''Follows the preferred parent of every node to the root, each node is only visited once.'''
+        ultimate = array('q', [UNKNOWN]) * len(self)
+        depth = array('q', [UNKNOWN]) * len(self)
+        for start in range(len(self)):
+            path = []
+            on_path = set()
+            node = start
+            while depth[node] == UNKNOWN and node not in on_path \
+                    and self.parent_offsets[node] != self.parent_offsets[node + 1]:
+                path.append(node)
+                on_path.add(node)
+                node = self.parents[self.parent_offsets[node]]
+            if depth[node] == UNKNOWN:
+                # A company without parents, or the company closing an ownership cycle, is its own ultimate parent
+                ultimate[node] = node
+                depth[node] = 0
+            for child in reversed(path):
+                if child == node:
+                    continue
+                parent = self.parents[self.parent_offsets[child]]
+                ultimate[child] = ultimate[parent]
+                depth[child] = depth[parent] + 1
+        return ultimate, depth
+
+    def groups(self):
+        '''Labels the weakly connected components by breadth-first search, the label is the smallest node.'''
+        group = array('q', [UNKNOWN]) * len(self)
+        for start in range(len(self)):
+            if group[start] != UNKNOWN:
+                continue
+            group[start] = start
+            queue = deque([start])
+            while queue:
+                node = queue.popleft()
+                for neighbour in self.neighbours[self.neighbour_offsets[node]:self.neighbour_offsets[node + 1]]:
+                    if group[neighbour] == UNKNOWN:
+                        group[neighbour] = start
+                        queue.append(neighbour)
+        return group
+
+def company_edges(connection):
+    companies_by_lei = {}
+    for lei, id in connection.execute(SELECT_RB_LEI):
+        companies_by_lei.setdefault(lei, []).append(id)
+    print(f'{len(companies_by_lei)} LEI records matched to RB companies', file=sys.stderr)
+
+    for child_lei, parent_lei, relationship_type in tqdm(connection.execute(SELECT_RELATIONSHIPS),
+                                                          desc='Loading relationships'):
+        for child in companies_by_lei.get(child_lei, []):
+            for parent in companies_by_lei.get(parent_lei, []):
+                yield child, parent, RELATIONSHIP_RANK[relationship_type]
+
+def materialize(connection):
+    with span('read') as read:
+        edges = list(company_edges(connection))
+        read.rows = len(edges)
+    with span('graph'):
+        graph = OwnershipGraph(edges)
+        ultimate, depth = graph.ultimate_parents()
+        group = graph.groups()
+    group_sizes = {}
+    for label in group:
+        group_sizes[label] = group_sizes.get(label, 0) + 1
+
+    with span('write', rows=len(graph)):
+        connection.execute('DROP TABLE IF EXISTS parents')
+        connection.execute('DROP TABLE IF EXISTS ownership')
+        connection.execute(CREATE_PARENTS)
+        connection.execute(CREATE_OWNERSHIP)
+        connection.executemany(
+            'INSERT INTO parents VALUES (?, ?)',
+            (
+                (graph.companies[parent], graph.companies[child])
+                for child in range(len(graph))
+                for parent in set(graph.parents[graph.parent_offsets[child]:graph.parent_offsets[child + 1]])
+            )
+        )
+        connection.executemany(
+            'INSERT INTO ownership VALUES (?, ?, ?, ?, ?)',
+            (
+                (graph.companies[i], graph.companies[ultimate[i]], depth[i], graph.companies[group[i]],
+                 group_sizes[group[i]])
+                for i in range(len(graph))
+            )
+        )
+        for create_index in CREATE_INDEXES:
+            connection.execute(create_index)
+    print(f'{len(graph)} companies in {len(group_sizes)} ownership groups, maximum depth {max(depth, default=0)}',
+          file=sys.stderr)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Materialize the ownership graph of the matched RB companies')
+    parser.add_argument('database', help='sqlite database to operate on')
+    parser.add_argument('--instrument', metavar='REPORT',
+                        help='write a report of spans and SQL timings to this JSON file')
+    parser.add_argument('--profile', help='write a sampling profile in folded format to this file')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    # Person deduplication may still write to the same database (see pipeline.py), see match.py
+    conn = sqlite3.connect(args.database, timeout=600, isolation_level='IMMEDIATE')
+    with instrumented(args.instrument, args.profile):
+        trace(conn)
+        materialize(conn)
+        with span('commit'):
+            conn.commit()
@@ -0,0 +1,105 @@
+import heapq
+import math
+import re
+from array import array
+from collections import defaultdict
+
+NON_ALPHANUMERIC = re.compile(r'[\W_]+')
+
+def normalize(name):
+    return NON_ALPHANUMERIC.sub(' ', name.lower()).strip()
+
+def trigrams(name):
+    padded = f'  {normalize(name)} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TrigramIndex:
+    '''
+    TF-IDF weighted character trigram index with an inverted list per block and trigram. Documents are (key, name,
+    block) tuples, e.g. with the postal code as block, and queries only touch the documents of one block sharing at
+    least one trigram and score them by the cosine similarity of their trigram sets.
+
+    Trigrams occurring in more than max_document_frequency of all documents (e.g. "gmb", "mbh") are skipped when
+    selecting candidates, as they would make every query scan most documents for little weight, and the best
+    rescore_factor * k candidates are then scored exactly. Names made only of such trigrams fall back to the shortest
+    posting list of them, all of whose documents are scored exactly.
+    '''
+
+    def __init__(self, documents, max_document_frequency=0.02, rescore_factor=5):
+        self.rescore_factor = rescore_factor
+        self.keys = []
+        self.names = []
+        postings = defaultdict(lambda: defaultdict(lambda: array('I')))
+        document_frequencies = defaultdict(int)
+        for key, name, block in documents:
+            doc = len(self.keys)
+            self.keys.append(key)
+            self.names.append(name)
+            for trigram in trigrams(name):
+                postings[block][trigram].append(doc)
+                document_frequencies[trigram] += 1
+        # Plain dicts, so lookups of missing blocks or trigrams do not insert empty entries
+        self.postings = {block: dict(block_postings) for block, block_postings in postings.items()}
+
+        num_docs = max(len(self.keys), 1)
+        self.idf = {
+            trigram: math.log((num_docs + 1) / (count + 1)) + 1 for trigram, count in document_frequencies.items()
+        }
+        # Trigrams which are not indexed at all are weighted like the rarest ones
+        self.max_idf = math.log(num_docs + 1) + 1
+        self.norms = array('d', [0.0]) * len(self.keys)
+        for block_postings in self.postings.values():
+            for trigram, docs in block_postings.items():
+                weight = self.weight(trigram)
+                for doc in docs:
+                    self.norms[doc] += weight
+        for doc in range(len(self.norms)):
+            self.norms[doc] = math.sqrt(self.norms[doc])
+
+        self.common = {
+            trigram for trigram, count in document_frequencies.items() if count > max_document_frequency * num_docs
+        }
+
+    def query(self, name, k=1, threshold=0.0, block=None):
+        '''
+        Returns up to k (score, key) tuples of the documents in block with a score of at least threshold, best first.
+        '''
+        query_trigrams = trigrams(name)
+        query_norm = math.sqrt(sum(self.weight(trigram) for trigram in query_trigrams))
+        block_postings = self.postings.get(block)
+        if query_norm == 0 or block_postings is None:
+            return []
+
+        posting_lists = [
+            (trigram, docs) for trigram in query_trigrams if (docs := block_postings.get(trigram)) is not None
+        ]
+        selective = [(trigram, docs) for trigram, docs in posting_lists if trigram not in self.common]
+        if selective:
+            dot_products = defaultdict(float)
+            for trigram, docs in selective:
+                weight = self.weight(trigram)
+                for doc in docs:
+                    dot_products[doc] += weight
+            candidates = heapq.nlargest(
+                self.rescore_factor * k, ((dot / self.norms[doc], doc) for doc, dot in dot_products.items())
+            )
+        elif posting_lists:
+            # Only common trigrams, their candidates would all score the same, so score the shortest list exactly
+            candidates = [(0.0, doc) for doc in min((docs for _, docs in posting_lists), key=len)]
+        else:
+            return []
+        scores = (
+            (self.dot_product(query_trigrams, trigrams(self.names[doc])) / (query_norm * self.norms[doc]), doc)
+            for _, doc in candidates
+        )
+        return [
+            (score, self.keys[doc])
+            for score, doc in heapq.nlargest(k, scores)
+            if score >= threshold
+        ]
+
+    def weight(self, trigram):
+        return self.idf.get(trigram, self.max_idf) ** 2
+
+    def dot_product(self, trigrams1, trigrams2):
+        return sum(self.weight(trigram) for trigram in trigrams1 & trigrams2)
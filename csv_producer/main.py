@@ -7,6 +7,7 @@ import os
 import sys
 
 from producer import Producer
+from rb_crawler.instrumentation import instrumented, iterate, span
 
 dotenv.load_dotenv()
 
@@ -21,12 +22,15 @@ def produce_from_csv(filename, schema_cls, topic):
         reader = csv.DictReader(file)
         key_field = reader.fieldnames[0]
 
-        for row in reader:
-            event = schema_cls()
-            for key, value in row.items():
-                setattr(event, key.replace('.', '_'), value)
-            producer.produce(key=row[key_field], value=event)
-        producer.poll()
+        with span('produce') as produce:
+            for row in iterate('read', reader):
+                event = schema_cls()
+                for key, value in row.items():
+                    setattr(event, key.replace('.', '_'), value)
+                producer.produce(key=row[key_field], value=event)
+                produce.rows += 1
+        with span('flush'):
+            producer.poll()
 
 
 def import_object(description):
@@ -47,9 +51,12 @@ def parse_args():
     parser.add_argument('filename', help='csv file to import')
     parser.add_argument('schema', help='protobuf schema to use (should correspond to csv header): path/to/schema_pb2:Schema')
     parser.add_argument('topic', help='kafka topic to produce to')
+    parser.add_argument('--instrument', metavar='REPORT', help='write a report of the phases to this JSON file')
+    parser.add_argument('--profile', help='write a sampling profile in folded format to this file')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = parse_args()
-    produce_from_csv(args.filename, import_object(args.schema), args.topic)
+    with instrumented(args.instrument, args.profile):
+        produce_from_csv(args.filename, import_object(args.schema), args.topic)
@@ -0,0 +1,322 @@
+"""
+Runs the data integration pipeline of tasks 3 and 4 (see README.md) on a SQLite database exported by Kafka Connect.
+
+The stages form a dependency graph. Every stage has a fingerprint of its code, its SQL scripts, the raw tables it reads
+and the fingerprints of the stages it depends on, which is stored in the database after the stage succeeded. Stages
+whose fingerprint did not change are skipped, the others run as soon as their dependencies are done, so independent
+stages (e.g. person deduplication and LEI matching) run concurrently.
+
+    poetry run python pipeline.py --database data/corporate.sqlite
+"""
+from __future__ import annotations
+
+import dataclasses
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Set, Tuple
+
+import click
+
+from rb_crawler.instrumentation import instrumented, span, trace
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Stages of other processes may write to the database at the same time
+BUSY_TIMEOUT = 600
+
+CREATE_STATE = (
+    "CREATE TABLE IF NOT EXISTS pipeline_stages ("
+    "   stage TEXT PRIMARY KEY, fingerprint TEXT, finished_at TEXT, seconds REAL, row_counts TEXT"
+    ")"
+)
+
+
+@dataclasses.dataclass
+class Stage:
+    name: str
+    # Python script and its arguments, started in the directory of the script. {database} is replaced by its path.
+    command: List[str] = dataclasses.field(default_factory=list)
+    # SQL scripts executed in order instead of a command
+    scripts: List[str] = dataclasses.field(default_factory=list)
+    # Source files the result depends on, besides the script and the SQL scripts
+    code: List[str] = dataclasses.field(default_factory=list)
+    depends_on: List[str] = dataclasses.field(default_factory=list)
+    # Tables which are not written by any stage, e.g. the Kafka Connect export
+    source_tables: List[str] = dataclasses.field(default_factory=list)
+    # Tables whose row counts are reported
+    output_tables: List[str] = dataclasses.field(default_factory=list)
+    # Columns of the source tables, which are added to exports made before the field existed: {table: {column: type}}
+    source_columns: Dict[str, Dict[str, str]] = dataclasses.field(default_factory=dict)
+    # Stage is not idempotent, its dependencies have to run again before it can
+    rebuild_dependencies: bool = False
+
+    def files(self) -> List[str]:
+        return sorted({*self.code, *self.scripts, *self.command[:1]})
+
+
+# Imported by the scripts of all stages with a command
+INSTRUMENTATION = "rb_crawler/instrumentation.py"
+# The ownership stage replaces the parents of the exact name matches by those of the LEI matching, so the only script
+# reading the LEI tables is left out and the transformations do not depend on them
+TRANSFORMATIONS = sorted(
+    os.path.relpath(path, ROOT)
+    for path in glob.glob(os.path.join(ROOT, "transformations", "*.sql"))
+    if os.path.basename(path) != "5_create_parents.sql"
+)
+
+STAGES = [
+    Stage(
+        "transform",
+        scripts=TRANSFORMATIONS,
+        source_tables=["corporate-events"],
+        output_tables=["companies", "events", "persons", "corporate_roles"],
+        # Compressing the announcement texts is optional (see rb_crawler/rb_compression.py)
+        source_columns={"corporate-events": {"information_compressed": "BLOB", "dictionary_id": "TEXT"}},
+    ),
+    Stage(
+        "parse",
+        command=["rb_crawler/rb_parser.py", "--database", "{database}"],
+        code=["rb_crawler/rb_compression.py", INSTRUMENTATION],
+        depends_on=["transform"],
+        output_tables=["companies", "typed_events", "persons", "corporate_roles"],
+        # The parser fills the companies, persons and roles created by the transformations
+        rebuild_dependencies=True,
+    ),
+    Stage(
+        "deduplicate",
+        command=["rb_crawler/rb_person_deduplicator.py", "--database", "{database}"],
+        code=[
+            "rb_crawler/rb_person_candidates.py",
+            "rb_crawler/rb_person_clustering.py",
+            "rb_crawler/rb_person_scoring.py",
+            "transformations/8_create_related_companies.sql",
+            INSTRUMENTATION,
+        ],
+        depends_on=["parse"],
+        output_tables=["persons", "corporate_roles", "related_companies"],
+    ),
+    Stage(
+        "match",
+        command=["company_matching/match.py", "{database}"],
+        code=["company_matching/trigram_index.py", INSTRUMENTATION],
+        depends_on=["parse"],
+        source_tables=["lei-data"],
+        output_tables=["rb-lei"],
+    ),
+    Stage(
+        "ownership",
+        command=["company_matching/ownership.py", "{database}"],
+        code=[INSTRUMENTATION],
+        depends_on=["match"],
+        source_tables=["lei-relationship-data"],
+        output_tables=["parents", "ownership"],
+    ),
+]
+
+
+@dataclasses.dataclass
+class StageResult:
+    stage: str
+    status: str
+    seconds: float = 0.0
+    row_counts: Dict[str, Optional[int]] = dataclasses.field(default_factory=dict)
+
+
+def connect(database: str) -> sqlite3.Connection:
+    return sqlite3.connect(database, timeout=BUSY_TIMEOUT)
+
+
+def row_count(db_conn: sqlite3.Connection, table: str) -> Optional[int]:
+    try:
+        return db_conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+
+
+def table_fingerprint(db_conn: sqlite3.Connection, table: str) -> Optional[Tuple[int, int]]:
+    """
+    Row count and largest rowid, which change whenever rows are appended to or removed from the table. The raw
+    tables are only appended to by Kafka Connect, so this is enough and far cheaper than hashing their contents.
+    """
+    try:
+        return db_conn.execute(f'SELECT COUNT(*), coalesce(MAX(rowid), 0) FROM "{table}"').fetchone()
+    except sqlite3.OperationalError:
+        return None
+
+
+def add_missing_columns(db_conn: sqlite3.Connection, table: str, columns: Dict[str, str]):
+    existing = {column for _, column, *_ in db_conn.execute(f'PRAGMA table_info("{table}")')}
+    if not existing:
+        # The scripts report a missing table
+        return
+    for column, column_type in columns.items():
+        if column not in existing:
+            db_conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {column_type}')
+
+
+def file_digest(path: str) -> str:
+    with open(os.path.join(ROOT, path), "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+class Pipeline:
+    def __init__(self, database: str, stages: List[Stage], workers: int, instrument: Optional[str] = None):
+        self.database = os.path.abspath(database)
+        self.stages = {stage.name: stage for stage in stages}
+        self.workers = workers
+        # Directory the instrumentation reports of the stages are written to
+        self.instrument = os.path.abspath(instrument) if instrument is not None else None
+        with connect(self.database) as db_conn:
+            # Concurrent stages can read while another one writes
+            db_conn.execute("PRAGMA journal_mode = WAL")
+            db_conn.execute(CREATE_STATE)
+            self.stored = {
+                stage: fingerprint
+                for stage, fingerprint in db_conn.execute("SELECT stage, fingerprint FROM pipeline_stages")
+            }
+            self.fingerprints = {}
+            for stage in self.stages.values():
+                self.fingerprints[stage.name] = self.fingerprint(db_conn, stage)
+        db_conn.close()
+
+    def fingerprint(self, db_conn: sqlite3.Connection, stage: Stage) -> str:
+        """Stages are ordered topologically, so the fingerprints of the dependencies are known."""
+        inputs = {
+            "command": stage.command,
+            "files": {path: file_digest(path) for path in stage.files()},
+            "tables": {table: table_fingerprint(db_conn, table) for table in stage.source_tables},
+            "dependencies": {dependency: self.fingerprints[dependency] for dependency in stage.depends_on},
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def dependents(self, name: str) -> Set[str]:
+        dependents = set()
+        for stage in self.stages.values():
+            if name in stage.depends_on:
+                dependents |= {stage.name} | self.dependents(stage.name)
+        return dependents
+
+    def outdated(self, forced: Set[str]) -> Set[str]:
+        outdated = {name for name in self.stages if self.stored.get(name) != self.fingerprints[name]} | forced
+        while True:
+            required = set(outdated)
+            for name in outdated:
+                if self.stages[name].rebuild_dependencies:
+                    required |= set(self.stages[name].depends_on)
+                # Running a stage changes the input of all stages after it, even if its fingerprint did not change
+                required |= self.dependents(name)
+            if required == outdated:
+                return outdated
+            outdated = required
+
+    def run_stage(self, stage: Stage) -> StageResult:
+        # A stage which fails halfway must not be skipped by the next run
+        with connect(self.database) as db_conn:
+            db_conn.execute("DELETE FROM pipeline_stages WHERE stage = ?", (stage.name,))
+        db_conn.close()
+        start = time.perf_counter()
+        if stage.scripts:
+            db_conn = connect(self.database)
+            trace(db_conn)
+            for table, columns in stage.source_columns.items():
+                add_missing_columns(db_conn, table, columns)
+            for script in stage.scripts:
+                with open(os.path.join(ROOT, script)) as file, span(f"{stage.name}/{os.path.basename(script)}"):
+                    db_conn.executescript(file.read())
+            db_conn.commit()
+            db_conn.close()
+        else:
+            script, *arguments = stage.command
+            arguments = [argument.format(database=self.database) for argument in arguments]
+            if self.instrument is not None:
+                arguments += ["--instrument", os.path.join(self.instrument, f"{stage.name}.json")]
+            # Scripts outside of rb_crawler import it as a package, which is found without installing it this way
+            python_path = os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")]))
+            with span(stage.name):
+                subprocess.run(
+                    [sys.executable, os.path.basename(script), *arguments],
+                    cwd=os.path.join(ROOT, os.path.dirname(script)),
+                    env=dict(os.environ, PYTHONPATH=python_path),
+                    check=True,
+                )
+        seconds = time.perf_counter() - start
+
+        db_conn = connect(self.database)
+        row_counts = {table: row_count(db_conn, table) for table in stage.output_tables}
+        with db_conn:
+            db_conn.execute(
+                "INSERT OR REPLACE INTO pipeline_stages VALUES (?, ?, datetime('now'), ?, ?)",
+                (stage.name, self.fingerprints[stage.name], seconds, json.dumps(row_counts))
+            )
+        db_conn.close()
+        return StageResult(stage.name, "ran", seconds, row_counts)
+
+    def run(self, forced: Set[str] = frozenset(), dry_run: bool = False) -> List[StageResult]:
+        outdated = self.outdated(forced)
+        results = {name: StageResult(name, "skipped") for name in self.stages if name not in outdated}
+        if dry_run:
+            return [results.get(name, StageResult(name, "outdated")) for name in self.stages]
+
+        running: Dict[Future, str] = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                for name, stage in self.stages.items():
+                    ready = all(
+                        dependency in results and results[dependency].status in ("ran", "skipped")
+                        for dependency in stage.depends_on
+                    )
+                    if name not in results and name not in running.values() and ready:
+                        click.echo(f"Running {name}", err=True)
+                        running[executor.submit(self.run_stage, stage)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except (subprocess.CalledProcessError, sqlite3.Error) as error:
+                        click.echo(f"{name} failed: {error}", err=True)
+                        results[name] = StageResult(name, "failed")
+
+        # Stages after a failed one were never started
+        return [results.get(name, StageResult(name, "not run")) for name in self.stages]
+
+
+def print_report(results: List[StageResult]):
+    click.echo(f"{'stage':14}{'status':10}{'seconds':>10}  rows")
+    for result in results:
+        rows = ", ".join(f"{table}={count}" for table, count in result.row_counts.items())
+        click.echo(f"{result.stage:14}{result.status:10}{result.seconds:>10.1f}  {rows}")
+
+
+@click.command()
+@click.option("-d", "--database", required=True, help="The sqlite database file exported by Kafka Connect")
+@click.option("-f", "--force", multiple=True, type=click.Choice([stage.name for stage in STAGES]),
+              help="Run this stage (and the stages after it) even if its inputs did not change")
+@click.option("-w", "--workers", type=int, default=2, help="Number of stages running at the same time")
+@click.option("--dry-run", is_flag=True, help="Only report which stages are outdated")
+@click.option("--report", type=click.Path(), default=None, help="Also write the report to this JSON file")
+@click.option("--instrument", type=click.Path(file_okay=False), default=None,
+              help="Write instrumentation reports of the pipeline (pipeline.json) and of every stage to this directory")
+def run(database, force, workers, dry_run, report, instrument):
+    if instrument is not None:
+        os.makedirs(instrument, exist_ok=True)
+    with instrumented(os.path.join(instrument, "pipeline.json") if instrument is not None else None):
+        results = Pipeline(database, STAGES, workers, instrument).run(set(force), dry_run)
+    print_report(results)
+    if report is not None:
+        with open(report, "w") as file:
+            json.dump([dataclasses.asdict(result) for result in results], file, indent=2)
+    if any(result.status in ("failed", "not run") for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,360 @@
+"""
+Indexes the parsed companies into Elasticsearch as one document per company, with its persons (and their roles in the
+company) and its typed events nested into it.
+
+The tables are streamed in company order and merged, so memory does not grow with the database. Every company
+document is fingerprinted and the fingerprints of the indexed documents are kept in the `elastic_index_state` table,
+so later runs only send the companies whose document changed and delete the companies which no longer exist.
+"""
+from __future__ import annotations
+
+import hashlib
+import itertools
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import click
+import requests
+
+log = logging.getLogger(__name__)
+
+COMPANY_COLUMNS = [
+    "id", "name", "state", "reference_id", "registration_authority", "is_active", "type", "address", "purpose",
+    "capital", "currency",
+]
+SELECT_COMPANIES = f"SELECT {', '.join(COMPANY_COLUMNS)} FROM companies ORDER BY id"
+SELECT_ROLES = (
+    "SELECT r.company_id, p.id, p.first_name, p.last_name, p.birth_date, p.birth_location, "
+    "   r.role, r.active, r.start_date, r.end_date "
+    "FROM corporate_roles r JOIN persons p ON p.id = r.person_id "
+    "ORDER BY r.company_id, p.id"
+)
+SELECT_EVENTS = "SELECT company_id, event_date, type, data FROM typed_events ORDER BY company_id, event_date"
+SELECT_STATE = "SELECT company_id, fingerprint FROM elastic_index_state ORDER BY company_id"
+
+CREATE_STATE = "CREATE TABLE IF NOT EXISTS elastic_index_state (company_id INTEGER PRIMARY KEY, fingerprint TEXT)"
+
+MAPPINGS = {
+    "properties": {
+        "name": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
+        "state": {"type": "keyword"},
+        "reference_id": {"type": "keyword"},
+        "registration_authority": {"type": "keyword"},
+        "is_active": {"type": "boolean"},
+        "type": {"type": "keyword"},
+        "address": {"type": "text"},
+        "purpose": {"type": "text"},
+        "capital": {"type": "double"},
+        "currency": {"type": "keyword"},
+        "persons": {
+            "type": "nested",
+            "properties": {
+                "first_name": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
+                "last_name": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
+                "birth_date": {"type": "date", "ignore_malformed": True},
+                "birth_location": {"type": "keyword"},
+                "roles": {
+                    "type": "nested",
+                    "properties": {
+                        "role": {"type": "keyword"},
+                        "active": {"type": "boolean"},
+                        "start_date": {"type": "date", "ignore_malformed": True},
+                        "end_date": {"type": "date", "ignore_malformed": True},
+                    },
+                },
+            },
+        },
+        "events": {
+            "type": "nested",
+            "properties": {
+                "date": {"type": "date", "ignore_malformed": True},
+                "type": {"type": "keyword"},
+                "data": {"type": "object", "enabled": False},
+            },
+        },
+    }
+}
+
+
+def grouped(rows: Iterable[tuple]) -> Iterator[Tuple[int, List[tuple]]]:
+    for company_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+        yield company_id, list(group)
+
+
+class GroupCursor:
+    """Groups of rows ordered by company id, advanced to a company on request."""
+
+    def __init__(self, rows: Iterable[tuple]):
+        self.groups = grouped(rows)
+        self.current = next(self.groups, None)
+
+    def take(self, company_id: int) -> List[tuple]:
+        while self.current is not None and self.current[0] < company_id:
+            self.current = next(self.groups, None)
+        if self.current is not None and self.current[0] == company_id:
+            rows = self.current[1]
+            self.current = next(self.groups, None)
+            return rows
+        return []
+
+    def take_before(self, company_id: int) -> List[Tuple[int, List[tuple]]]:
+        skipped = []
+        while self.current is not None and self.current[0] < company_id:
+            skipped.append(self.current)
+            self.current = next(self.groups, None)
+        return skipped
+
+    def remaining(self) -> Iterator[Tuple[int, List[tuple]]]:
+        if self.current is not None:
+            yield self.current
+            yield from self.groups
+
+
+def company_document(company: tuple, roles: List[tuple], events: List[tuple]) -> dict:
+    document = dict(zip(COMPANY_COLUMNS[1:], company[1:]))
+    document["is_active"] = bool(document["is_active"])
+    persons = {}
+    for _, person_id, first_name, last_name, birth_date, birth_location, role, active, start_date, end_date in roles:
+        person = persons.setdefault(person_id, {
+            "id": person_id,
+            "first_name": first_name,
+            "last_name": last_name,
+            "birth_date": birth_date,
+            "birth_location": birth_location,
+            "roles": [],
+        })
+        person["roles"].append({"role": role, "active": bool(active), "start_date": start_date, "end_date": end_date})
+    document["persons"] = list(persons.values())
+    document["events"] = [
+        {"date": event_date, "type": event_type, "data": json.loads(data) if data else None}
+        for _, event_date, event_type, data in events
+    ]
+    return document
+
+
+class Action:
+    """One bulk action: indexing a company document or, without a document, deleting a company."""
+
+    def __init__(self, company_id: int, document: Optional[dict] = None):
+        self.company_id = company_id
+        if document is None:
+            self.fingerprint = None
+            self.body = json.dumps({"delete": {"_id": company_id}}).encode() + b"\n"
+        else:
+            source = json.dumps(document, ensure_ascii=False, sort_keys=True).encode()
+            self.fingerprint = hashlib.sha1(source).hexdigest()
+            self.body = json.dumps({"index": {"_id": company_id}}).encode() + b"\n" + source + b"\n"
+
+
+class HttpTransport:
+    """The bulk API of an Elasticsearch server."""
+
+    def __init__(self, url: str, timeout: float = 120):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        # Sessions are not thread-safe, every worker thread has its own
+        self.local = threading.local()
+
+    def session(self) -> requests.Session:
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def create_index(self, index: str, mappings: dict):
+        response = self.session().put(f"{self.url}/{index}", json={"mappings": mappings}, timeout=self.timeout)
+        if response.status_code == 400 and "resource_already_exists" in response.text:
+            return
+        response.raise_for_status()
+
+    def bulk(self, index: str, body: bytes) -> Tuple[int, Optional[dict]]:
+        response = self.session().post(
+            f"{self.url}/{index}/_bulk",
+            data=body,
+            headers={"Content-Type": "application/x-ndjson"},
+            timeout=self.timeout,
+        )
+        return response.status_code, response.json() if response.status_code == 200 else None
+
+
+class StandInTransport:
+    """
+    Local stand-in for an Elasticsearch server, which answers bulk requests from memory and rejects a share of the
+    items with 429 like an overloaded cluster. Indexing against it exercises batching, retries and the index state
+    without a server.
+    """
+
+    def __init__(self, rejection_rate: float = 0.0, seed: int = 42):
+        self.rejection_rate = rejection_rate
+        self.random = random.Random(seed)
+        self.documents: Dict[str, dict] = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def create_index(self, index: str, mappings: dict):
+        pass
+
+    def bulk(self, index: str, body: bytes) -> Tuple[int, Optional[dict]]:
+        lines = iter(body.splitlines())
+        items = []
+        with self.lock:
+            self.requests += 1
+            for line in lines:
+                action, metadata = next(iter(json.loads(line).items()))
+                document = json.loads(next(lines)) if action == "index" else None
+                document_id = str(metadata["_id"])
+                if self.random.random() < self.rejection_rate:
+                    status = 429
+                elif action == "index":
+                    status = 200 if document_id in self.documents else 201
+                    self.documents[document_id] = document
+                else:
+                    status = 200 if self.documents.pop(document_id, None) is not None else 404
+                item = {"_id": document_id, "status": status}
+                if status == 429:
+                    item["error"] = {"type": "es_rejected_execution_exception"}
+                items.append({action: item})
+        return 200, {"errors": any(next(iter(item.values()))["status"] >= 300 for item in items), "items": items}
+
+
+class BulkIndexer:
+    def __init__(self, database: str, transport, index: str = "companies", workers: int = 4,
+                 batch_size: int = 1000, batch_bytes: int = 5 * 1024 * 1024, max_retries: int = 5):
+        # Read cursors stay open while the index state is updated through the second connection
+        self.read_conn = sqlite3.connect(database)
+        self.read_conn.execute("PRAGMA journal_mode = WAL")
+        self.read_conn.execute(CREATE_STATE)
+        self.read_conn.commit()
+        self.write_conn = sqlite3.connect(database)
+        self.transport = transport
+        self.index = index
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.max_retries = max_retries
+        self.stats = {"indexed": 0, "deleted": 0, "unchanged": 0, "failed": 0, "retries": 0, "requests": 0}
+
+    def actions(self, full: bool) -> Iterator[Action]:
+        """
+        The changed companies (all companies if full), merged from the ordered companies, roles, events and index
+        state. Companies in the index state which no longer exist are deleted in both cases.
+        """
+        roles = GroupCursor(self.read_conn.execute(SELECT_ROLES))
+        events = GroupCursor(self.read_conn.execute(SELECT_EVENTS))
+        state = GroupCursor(self.read_conn.execute(SELECT_STATE))
+        for company in self.read_conn.execute(SELECT_COMPANIES):
+            company_id = company[0]
+            for deleted_id, _ in state.take_before(company_id):
+                yield Action(deleted_id)
+            action = Action(company_id, company_document(company, roles.take(company_id), events.take(company_id)))
+            indexed = state.take(company_id)
+            if not full and indexed and indexed[0][1] == action.fingerprint:
+                self.stats["unchanged"] += 1
+                continue
+            yield action
+        for deleted_id, _ in state.remaining():
+            yield Action(deleted_id)
+
+    def batches(self, actions: Iterator[Action]) -> Iterator[List[Action]]:
+        """Batches of at most batch_size actions and (unless a single action is larger) batch_bytes bytes."""
+        batch, size = [], 0
+        for action in actions:
+            if batch and (len(batch) >= self.batch_size or size + len(action.body) > self.batch_bytes):
+                yield batch
+                batch, size = [], 0
+            batch.append(action)
+            size += len(action.body)
+        if batch:
+            yield batch
+
+    def send(self, batch: List[Action]) -> Tuple[List[Action], int, int, int]:
+        """
+        Sends a batch, retrying rejected actions with exponential backoff. Returns the succeeded actions, the number
+        of failed actions, of retries and of requests.
+        """
+        succeeded, failed, retries, requests_sent = [], 0, 0, 0
+        pending = batch
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                retries += 1
+                time.sleep(min(2 ** attempt * 0.1, 30) * (1 + random.random()))
+            status, response = self.transport.bulk(self.index, b"".join(action.body for action in pending))
+            requests_sent += 1
+            if status in (429, 502, 503, 504):
+                continue
+            if response is None:
+                raise RuntimeError(f"Bulk request failed with status {status}")
+            rejected = []
+            for action, item in zip(pending, response["items"]):
+                result = next(iter(item.values()))
+                if result["status"] == 429:
+                    rejected.append(action)
+                elif result["status"] < 300 or (action.fingerprint is None and result["status"] == 404):
+                    succeeded.append(action)
+                else:
+                    log.warning(f"Company {action.company_id} was not indexed: {result.get('error')}")
+                    failed += 1
+            pending = rejected
+            if not pending:
+                break
+        return succeeded, failed + len(pending), retries, requests_sent
+
+    def record(self, future: Future):
+        succeeded, failed, retries, requests_sent = future.result()
+        deleted = [(action.company_id,) for action in succeeded if action.fingerprint is None]
+        self.write_conn.executemany("DELETE FROM elastic_index_state WHERE company_id = ?", deleted)
+        self.write_conn.executemany(
+            "INSERT OR REPLACE INTO elastic_index_state VALUES (?, ?)",
+            ((action.company_id, action.fingerprint) for action in succeeded if action.fingerprint is not None)
+        )
+        self.write_conn.commit()
+        self.stats["indexed"] += len(succeeded) - len(deleted)
+        self.stats["deleted"] += len(deleted)
+        self.stats["failed"] += failed
+        self.stats["retries"] += retries
+        self.stats["requests"] += requests_sent
+
+    def run(self, full: bool = False) -> dict:
+        self.transport.create_index(self.index, MAPPINGS)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            in_flight = deque()
+            for batch in self.batches(self.actions(full)):
+                # At most two batches per worker are built ahead of the requests
+                if len(in_flight) >= 2 * self.workers:
+                    self.record(in_flight.popleft())
+                in_flight.append(executor.submit(self.send, batch))
+            while in_flight:
+                self.record(in_flight.popleft())
+        self.stats["seconds"] = round(time.perf_counter() - start, 1)
+        self.read_conn.close()
+        self.write_conn.close()
+        return self.stats
+
+
+@click.command()
+@click.option("-d", "--database", default="../data/corporate-new.sqlite", help="The sqlite database file to connect to")
+@click.option("--url", default="http://localhost:9200", help="The Elasticsearch server")
+@click.option("--index", default="companies", help="The index of the company documents")
+@click.option("-w", "--workers", type=int, default=4, help="Number of concurrent bulk requests")
+@click.option("--batch-size", type=int, default=1000, help="Maximum number of documents per bulk request")
+@click.option("--batch-bytes", type=int, default=5 * 1024 * 1024, help="Maximum size of a bulk request")
+@click.option("--max-retries", type=int, default=5, help="Retries of rejected documents")
+@click.option("--full", is_flag=True, help="Index all companies, not only the changed ones")
+@click.option("--stand-in", is_flag=True, help="Index into a local in-memory stand-in instead of --url")
+@click.option("--rejection-rate", type=float, default=0.0, help="Stand-in: share of documents rejected with 429")
+def run(database, url, index, workers, batch_size, batch_bytes, max_retries, full, stand_in, rejection_rate):
+    transport = StandInTransport(rejection_rate) if stand_in else HttpTransport(url)
+    stats = BulkIndexer(database, transport, index, workers, batch_size, batch_bytes, max_retries).run(full)
+    click.echo(", ".join(f"{key}: {value}" for key, value in stats.items()))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run()
@@ -0,0 +1,374 @@
+"""
+Instrumentation of the batch entry points (rb_parser, rb_person_deduplicator, company_matching/match.py and
+ownership.py, and csv_producer), which all enable it with the same flags:
+
+    --instrument report.json   write a JSON report of the run and print a summary to stderr
+    --profile profile.folded   also sample the stacks of all threads and write them in the folded format of
+                               flamegraph.pl (https://github.com/brendangregg/FlameGraph) and speedscope
+
+The report holds the wall and CPU time, the peak RSS, the time and rows of every span (named phases like read, parse,
+block, score and write, nested spans are named by their path) and the statements of the traced SQLite connections.
+pipeline.py --instrument <directory> writes a report per stage. Reports of two runs are compared by
+
+    poetry run python -m rb_crawler.instrumentation before.json after.json
+
+Until instrumented() is entered all functions are no-ops, so the phases can stay instrumented at little cost. Worker
+processes (e.g. of the scorer) are not instrumented themselves, their CPU time and peak RSS are reported as children.
+
+SQLite only tells when a statement starts, so a statement is timed until the next statement starts or a span begins or
+ends. Statements should therefore be executed within spans of their own for accurate timings.
+"""
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import click
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SAMPLING_INTERVAL = 0.005
+REPORTED_STATEMENTS = 20
+REPORTED_FUNCTIONS = 20
+
+LITERALS = re.compile(r"[Xx]?'(?:[^']|'')*'|(?<![\w.\"`])-?\d+(?:\.\d+)?(?![\w\"`])")
+LISTS = re.compile(r"\?(?:\s*,\s*\?){2,}")
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_statement(statement: str) -> str:
+    """The trace callback gets the statements with their parameters, which are replaced by ? to group them."""
+    statement = LITERALS.sub("?", statement)
+    statement = LISTS.sub("?, ...", statement)
+    return WHITESPACE.sub(" ", statement).strip()
+
+
+def statement_shape(statement: str) -> bytes:
+    """
+    The statement without its string literals and digits, a much cheaper key than normalize_statement: statements of
+    the same shape only differ in their parameters (or in digits of identifiers), so they normalize alike.
+    """
+    return "'".join(statement.split("'")[::2]).encode().translate(None, b"0123456789")
+
+
+def peak_rss(children: bool = False) -> Optional[int]:
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # Linux reports kibibytes, macOS bytes
+    return usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def cpu_seconds(children: bool = False) -> Optional[float]:
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+@dataclasses.dataclass
+class Statistics:
+    count: int = 0
+    seconds: float = 0.0
+    rows: int = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "seconds": self.seconds,
+            "rows": self.rows,
+            "rows_per_second": self.rows / self.seconds if self.seconds > 0 else None,
+        }
+
+
+class Span:
+    """Yielded by span(), rows processed within the span can be added to rows."""
+
+    def __init__(self, rows: int = 0):
+        self.rows = rows
+
+
+class Sampler(threading.Thread):
+    """Samples the stacks of all other threads, only the frames are inspected, so it works without any hooks."""
+
+    def __init__(self, interval: float):
+        super().__init__(name="instrumentation-sampler", daemon=True)
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, path: str):
+        with open(path, "w") as file:
+            for stack, count in self.samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+    def top_functions(self) -> List[dict]:
+        own, total = Counter(), Counter()
+        for stack, count in self.samples.items():
+            frames = stack.split(";")[1:]
+            # Threads waiting for a lock or an event (e.g. the monitor of tqdm) are idle
+            if not frames or "(threading.py:" in frames[-1]:
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return [
+            {"function": function, "own_samples": count, "total_samples": total[function]}
+            for function, count in own.most_common(REPORTED_FUNCTIONS)
+        ]
+
+
+class Recorder:
+    def __init__(self, sampling_interval: Optional[float] = None):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans: Dict[str, Statistics] = {}
+        self.statements: Dict[str, Statistics] = {}
+        # Normalized statement of every shape seen
+        self.normalized: Dict[bytes, str] = {}
+        self.sampler = Sampler(sampling_interval) if sampling_interval is not None else None
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        if self.sampler is not None:
+            self.sampler.start()
+
+    def stack(self) -> List[str]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def path(self, name: str) -> str:
+        path = "/".join([*self.stack(), name])
+        # Spans are reported in the order they were first entered
+        if path not in self.spans:
+            with self.lock:
+                self.spans.setdefault(path, Statistics())
+        return path
+
+    def record_span(self, path: str, seconds: float, rows: int):
+        with self.lock:
+            statistics = self.spans[path]
+            statistics.count += 1
+            statistics.seconds += seconds
+            statistics.rows += rows
+
+    @contextlib.contextmanager
+    def span(self, name: str, rows: int) -> Iterator[Span]:
+        path = self.path(name)
+        span = Span(rows)
+        self.end_statement()
+        self.stack().append(name)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            self.end_statement()
+            self.stack().pop()
+            self.record_span(path, time.perf_counter() - start, span.rows)
+
+    def iterate(self, name: str, iterable: Iterable) -> Iterator:
+        path = self.path(name)
+        seconds, rows = 0.0, 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    seconds += time.perf_counter() - start
+                    return
+                seconds += time.perf_counter() - start
+                rows += 1
+                yield item
+        finally:
+            self.record_span(path, seconds, rows)
+
+    def trace_statement(self, statement: str):
+        now = time.perf_counter()
+        self.end_statement(now)
+        self.local.statement = (statement, now)
+
+    def end_statement(self, now: Optional[float] = None):
+        pending = getattr(self.local, "statement", None)
+        if pending is None:
+            return
+        self.local.statement = None
+        statement, start = pending
+        # The callback runs for every execution, e.g. for every row of an executemany with its parameters filled in,
+        # so the regular expressions of normalize_statement only run once per shape of statement
+        shape = statement_shape(statement)
+        if (normalized := self.normalized.get(shape)) is None:
+            normalized = self.normalized[shape] = normalize_statement(statement)
+        statement = normalized
+        with self.lock:
+            statistics = self.statements.setdefault(statement, Statistics())
+            statistics.count += 1
+            statistics.seconds += (now if now is not None else time.perf_counter()) - start
+
+    def report(self, profile: Optional[str]) -> dict:
+        self.end_statement()
+        if self.sampler is not None:
+            self.sampler.stop()
+            if profile is not None:
+                self.sampler.write(profile)
+        seconds = time.perf_counter() - self.start
+        statements = sorted(self.statements.items(), key=lambda item: item[1].seconds, reverse=True)
+        report = {
+            "command": sys.argv,
+            "started_at": self.started_at.isoformat(),
+            "seconds": seconds,
+            "cpu_seconds": cpu_seconds(),
+            "children_cpu_seconds": cpu_seconds(children=True),
+            "peak_rss_bytes": peak_rss(),
+            "children_peak_rss_bytes": peak_rss(children=True),
+            "spans": {path: statistics.to_dict() for path, statistics in self.spans.items()},
+            "sql": {
+                "statements": sum(statistics.count for _, statistics in statements),
+                "seconds": sum(statistics.seconds for _, statistics in statements),
+                "slowest": [
+                    {"statement": statement, **statistics.to_dict()}
+                    for statement, statistics in statements[:REPORTED_STATEMENTS]
+                ],
+            },
+        }
+        if self.sampler is not None:
+            report["profile"] = {
+                "file": profile,
+                "interval": self.sampler.interval,
+                "samples": sum(self.sampler.samples.values()),
+                "top_functions": self.sampler.top_functions(),
+            }
+        return report
+
+
+recorder: Optional[Recorder] = None
+
+
+@contextlib.contextmanager
+def instrumented(report: Optional[str] = None, profile: Optional[str] = None,
+                 sampling_interval: float = SAMPLING_INTERVAL) -> Iterator[None]:
+    """Enables the instrumentation if a report or profile file is given, and writes them when the block is left."""
+    global recorder
+    if report is None and profile is None:
+        yield
+        return
+    recorder = Recorder(sampling_interval if profile is not None else None)
+    try:
+        yield
+    finally:
+        result = recorder.report(profile)
+        recorder = None
+        print_summary(result)
+        if report is not None:
+            with open(report, "w") as file:
+                json.dump(result, file, indent=2)
+
+
+def span(name: str, rows: int = 0):
+    """Times the block as a phase of the enclosing span. Rows processed in the block are passed or added to span.rows."""
+    if recorder is None:
+        return contextlib.nullcontext(Span(rows))
+    return recorder.span(name, rows)
+
+
+def iterate(name: str, iterable: Iterable) -> Iterable:
+    """Times fetching the items of the iterable, e.g. the rows of a cursor, as a span and counts them as its rows."""
+    if recorder is None:
+        return iterable
+    return recorder.iterate(name, iterable)
+
+
+def trace(db_conn: sqlite3.Connection):
+    """Times the statements executed on the connection."""
+    if recorder is not None:
+        # The recorder of this run, the connection may outlive it
+        db_conn.set_trace_callback(recorder.trace_statement)
+
+
+def format_bytes(value: Optional[int]) -> str:
+    return f"{value / 2 ** 20:.0f} MiB" if value is not None else "-"
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return f"{value:.2f}" if value is not None else "-"
+
+
+def print_summary(report: dict):
+    def echo(line: str = ""):
+        click.echo(line, err=True)
+
+    echo()
+    echo(f"{report['seconds']:.1f}s, {report['cpu_seconds'] or 0:.1f}s CPU ({report['children_cpu_seconds'] or 0:.1f}s "
+         f"in child processes), peak RSS {format_bytes(report['peak_rss_bytes'])} "
+         f"({format_bytes(report['children_peak_rss_bytes'])} in child processes)")
+    echo(f"{'span':40}{'count':>10}{'seconds':>10}{'share':>8}{'rows':>12}{'rows/s':>12}")
+    for path, statistics in report["spans"].items():
+        rows_per_second = statistics["rows_per_second"]
+        echo(f"{path:40}{statistics['count']:>10}{statistics['seconds']:>10.2f}"
+             f"{statistics['seconds'] / max(report['seconds'], 1e-9):>8.1%}{statistics['rows']:>12}"
+             f"{rows_per_second if rows_per_second is not None else 0:>12.0f}")
+    if report["sql"]["statements"]:
+        echo(f"{report['sql']['statements']} SQL statements in {report['sql']['seconds']:.1f}s, slowest:")
+        for statement in report["sql"]["slowest"][:5]:
+            echo(f"  {statement['seconds']:>8.2f}s {statement['count']:>9}x  {statement['statement'][:100]}")
+
+
+def change(before: Optional[float], after: Optional[float]) -> str:
+    if not before or after is None:
+        return ""
+    return f"{(after - before) / before:+.1%}"
+
+
+@click.command()
+@click.argument("before", type=click.File())
+@click.argument("after", type=click.File())
+def compare(before, after):
+    """Compares the spans, durations and peak RSS of two reports."""
+    before, after = json.load(before), json.load(after)
+    click.echo(f"{'':40}{'before':>12}{'after':>12}{'change':>10}")
+    for key in ("seconds", "cpu_seconds", "children_cpu_seconds"):
+        click.echo(f"{key:40}{format_seconds(before[key]):>12}{format_seconds(after[key]):>12}"
+                   f"{change(before[key], after[key]):>10}")
+    for key in ("peak_rss_bytes", "children_peak_rss_bytes"):
+        click.echo(f"{key:40}{format_bytes(before[key]):>12}{format_bytes(after[key]):>12}"
+                   f"{change(before[key], after[key]):>10}")
+    for path in [*before["spans"], *(path for path in after["spans"] if path not in before["spans"])]:
+        old, new = before["spans"].get(path, {}).get("seconds"), after["spans"].get(path, {}).get("seconds")
+        click.echo(f"{path:40}{format_seconds(old):>12}{format_seconds(new):>12}{change(old, new):>10}")
+
+
+if __name__ == "__main__":
+    compare()
@@ -1,9 +1,11 @@
 import logging
 import os
+from typing import Optional
 
 import click
 
 from constant import State
+from rb_compression import Compressor
 from rb_extractor import RbExtractor
 
 logging.basicConfig(
@@ -17,8 +19,11 @@ log = logging.getLogger(__name__)
 @click.option("-s", "--state", type=click.Choice(State), help="The state ISO code")
 @click.option("-d", "--delay", type=float, help="The delay between each request", default=0.5)
 @click.option("-t", "--step-size", type=int, help="By how much the rb_id is incremented each step", default=1)
-def run(rb_id: int, state: State, delay: float = 0.5, step_size: int = 1):
-    RbExtractor(rb_id, state, delay=delay, step=step_size).extract()
+@click.option("--dictionary", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Compress the announcement texts with this dictionary (see rb_compression.py)")
+def run(rb_id: int, state: State, delay: float = 0.5, step_size: int = 1, dictionary: Optional[str] = None):
+    compressor = Compressor.load(dictionary) if dictionary is not None else None
+    RbExtractor(rb_id, state, delay=delay, step=step_size, compressor=compressor).extract()
 
 
 if __name__ == "__main__":
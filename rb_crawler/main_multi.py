@@ -1,34 +1,43 @@
 import logging
 import os
+import threading
+from typing import Optional
+
+import click
 
 from constant import State
+from rb_compression import Compressor
 from rb_extractor import RbExtractor
-import threading
-import argparse
 
 logging.basicConfig(
     level=os.environ.get("LOGLEVEL", "INFO"), format="%(asctime)s | %(name)s | %(levelname)s | %(message)s"
 )
 log = logging.getLogger(__name__)
 
-def run():
+
+@click.command()
+@click.option("--dictionary", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Compress the announcement texts with this dictionary (see rb_compression.py)")
+def run(dictionary: Optional[str] = None):
+    # The compressor keeps no state between texts, so the extractor threads share it
+    compressor = Compressor.load(dictionary) if dictionary is not None else None
     extractors = [
-        RbExtractor(0, State.BADEN_WUETTEMBERG),
-        RbExtractor(0, State.BAYERN),
-        RbExtractor(0, State.BERLIN),
-        RbExtractor(0, State.BRANDENBURG),
-        RbExtractor(0, State.BREMEN),
-        RbExtractor(0, State.HAMBURG),
-        RbExtractor(0, State.HESSEN),
-        RbExtractor(0, State.MECKLENBURG_VORPOMMERN),
-        RbExtractor(0, State.NIEDERSACHSEN),
-        RbExtractor(0, State.NORDRHEIN_WESTFALEN),
-        RbExtractor(0, State.RHEILAND_PFALZ),
-        RbExtractor(0, State.SAARLAND),
-        RbExtractor(0, State.SACHSEN),
-        RbExtractor(0, State.SACHSEN_ANHALT),
-        RbExtractor(7831, State.SCHLESWIG_HOLSTEIN),
-        RbExtractor(0, State.THUERINGEN),
+        RbExtractor(0, State.BADEN_WUETTEMBERG, compressor=compressor),
+        RbExtractor(0, State.BAYERN, compressor=compressor),
+        RbExtractor(0, State.BERLIN, compressor=compressor),
+        RbExtractor(0, State.BRANDENBURG, compressor=compressor),
+        RbExtractor(0, State.BREMEN, compressor=compressor),
+        RbExtractor(0, State.HAMBURG, compressor=compressor),
+        RbExtractor(0, State.HESSEN, compressor=compressor),
+        RbExtractor(0, State.MECKLENBURG_VORPOMMERN, compressor=compressor),
+        RbExtractor(0, State.NIEDERSACHSEN, compressor=compressor),
+        RbExtractor(0, State.NORDRHEIN_WESTFALEN, compressor=compressor),
+        RbExtractor(0, State.RHEILAND_PFALZ, compressor=compressor),
+        RbExtractor(0, State.SAARLAND, compressor=compressor),
+        RbExtractor(0, State.SACHSEN, compressor=compressor),
+        RbExtractor(0, State.SACHSEN_ANHALT, compressor=compressor),
+        RbExtractor(7831, State.SCHLESWIG_HOLSTEIN, compressor=compressor),
+        RbExtractor(0, State.THUERINGEN, compressor=compressor),
             ]
     threads = []
 
@@ -0,0 +1,177 @@
+"""
+Compression of the announcement texts (`Corporate.information`) with a shared preset dictionary.
+
+The texts are short and mostly legal boilerplate, so compressing each one on its own gains little, but compressing them
+against a dictionary of the common phrases does: deflate can refer to the dictionary like to text seen before. The
+dictionary is trained once on a sample of texts and stored as dictionaries/<id>.zdict, where the id is derived from its
+contents. Compressed records carry that id, so texts compressed with older dictionaries stay readable.
+
+    poetry run python -m rb_crawler.rb_compression --database data/corporate.sqlite --output dictionaries
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import click
+
+log = logging.getLogger(__name__)
+
+DICTIONARIES = Path(__file__).resolve().parent.parent / "dictionaries"
+
+# Deflate only looks back 32 KiB, so a larger dictionary would not be used
+MAX_DICTIONARY_SIZE = 32 * 1024
+SEGMENT_SIZE = 64
+DMER_SIZE = 8
+# Raw deflate streams, without the zlib header and checksum, which would be a large part of short texts
+WBITS = -15
+
+
+def dictionary_id(dictionary: bytes) -> str:
+    return hashlib.sha256(dictionary).hexdigest()[:16]
+
+
+def save_dictionary(dictionary: bytes, directory: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    identifier = dictionary_id(dictionary)
+    with open(os.path.join(directory, f"{identifier}.zdict"), "wb") as file:
+        file.write(dictionary)
+    return identifier
+
+
+class Compressor:
+    def __init__(self, dictionary: bytes, level: int = 9):
+        self.dictionary = dictionary
+        self.dictionary_id = dictionary_id(dictionary)
+        self.level = level
+
+    @classmethod
+    def load(cls, path: str) -> "Compressor":
+        with open(path, "rb") as file:
+            return cls(file.read())
+
+    def compress(self, text: str) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS, zdict=self.dictionary)
+        return compressor.compress(text.encode()) + compressor.flush()
+
+
+class Decompressor:
+    """Decompresses texts of any dictionary in the directory, loading each dictionary when it is first needed."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.dictionaries: Dict[str, bytes] = {}
+
+    def dictionary(self, identifier: str) -> bytes:
+        if identifier not in self.dictionaries:
+            path = os.path.join(self.directory, f"{identifier}.zdict")
+            try:
+                with open(path, "rb") as file:
+                    self.dictionaries[identifier] = file.read()
+            except FileNotFoundError:
+                raise LookupError(f"Compression dictionary {identifier} not found, expected it at {path}") from None
+        return self.dictionaries[identifier]
+
+    def decompress(self, data: bytes, identifier: str) -> str:
+        decompressor = zlib.decompressobj(WBITS, zdict=self.dictionary(identifier))
+        return (decompressor.decompress(data) + decompressor.flush()).decode()
+
+
+def best_segment(data: bytes, start: int, end: int, frequencies: Counter) -> Optional[Tuple[int, int]]:
+    """
+    The segment of data[start:end] with the largest sum of frequencies of the distinct dmers it contains, as
+    (score, offset). The window slides over the range, so the whole range is scanned once.
+    """
+    end = min(end, len(data)) - DMER_SIZE + 1
+    if end - start < SEGMENT_SIZE - DMER_SIZE + 1:
+        return None
+    dmers_per_segment = SEGMENT_SIZE - DMER_SIZE + 1
+    active = Counter()
+    score = 0
+    best = None
+    for position in range(start, end):
+        dmer = data[position:position + DMER_SIZE]
+        if active[dmer] == 0:
+            score += frequencies[dmer]
+        active[dmer] += 1
+        first = position - dmers_per_segment + 1
+        if first < start:
+            continue
+        if best is None or score > best[0]:
+            best = (score, first)
+        leaving = data[first:first + DMER_SIZE]
+        active[leaving] -= 1
+        if active[leaving] == 0:
+            score -= frequencies[leaving]
+    return best
+
+
+def train_dictionary(samples: Iterable[bytes], size: int = MAX_DICTIONARY_SIZE) -> bytes:
+    """
+    Builds a dictionary of the segments covering the most frequent substrings of the samples, similar to the cover
+    algorithm of zstd: the samples are split into one epoch per segment of the dictionary, the best segment of each
+    epoch is selected and its substrings no longer count for the following epochs. A substring is counted once per
+    sample it occurs in, so phrases shared by many texts win over repetitions within one.
+    """
+    samples = [sample for sample in samples if len(sample) >= DMER_SIZE]
+    frequencies = Counter()
+    for sample in samples:
+        frequencies.update({sample[i:i + DMER_SIZE] for i in range(len(sample) - DMER_SIZE + 1)})
+    data = b"".join(samples)
+
+    epochs = max(1, size // SEGMENT_SIZE)
+    epoch_size = max(SEGMENT_SIZE, len(data) // epochs)
+    segments: List[Tuple[int, bytes]] = []
+    for start in range(0, len(data), epoch_size):
+        best = best_segment(data, start, start + epoch_size, frequencies)
+        if best is None or best[0] == 0:
+            continue
+        score, offset = best
+        segment = data[offset:offset + SEGMENT_SIZE]
+        for i in range(len(segment) - DMER_SIZE + 1):
+            frequencies[segment[i:i + DMER_SIZE]] = 0
+        segments.append((score, segment))
+
+    # Deflate encodes short distances with fewer bits, so the most valuable segments go to the end of the dictionary,
+    # right before the text
+    segments.sort(key=lambda segment: segment[0])
+    return b"".join(segment for _, segment in segments)[-size:]
+
+
+def compression_ratio(compressor: Compressor, samples: List[bytes]) -> float:
+    compressed = sum(len(compressor.compress(sample.decode())) for sample in samples)
+    return sum(map(len, samples)) / max(compressed, 1)
+
+
+@click.command()
+@click.option("-d", "--database", required=True, help="The sqlite database file with the corporate-events table")
+@click.option("-o", "--output", default=str(DICTIONARIES), help="Directory the dictionary is written to")
+@click.option("-n", "--samples", type=int, default=5000, help="Number of texts to train on")
+@click.option("--size", type=click.IntRange(1024, MAX_DICTIONARY_SIZE), default=MAX_DICTIONARY_SIZE,
+              help="Size of the dictionary in bytes")
+def run(database: str, output: str, samples: int, size: int):
+    db_conn = sqlite3.connect(database)
+    texts = [
+        text.encode() for text, in db_conn.execute(
+            'SELECT information FROM "corporate-events" WHERE information != \'\' ORDER BY random() LIMIT ?',
+            (2 * samples,)
+        )
+    ]
+    db_conn.close()
+    # The texts not trained on tell how well the dictionary generalizes
+    training, validation = texts[:samples], texts[samples:]
+    dictionary = train_dictionary(training, size)
+    identifier = save_dictionary(dictionary, output)
+    click.echo(f"Wrote {len(dictionary)} byte dictionary {identifier} to {output}, trained on {len(training)} texts")
+    if validation:
+        click.echo(f"Compression ratio of {len(validation)} other texts: "
+                   f"{compression_ratio(Compressor(dictionary), validation):.2f} with the dictionary, "
+                   f"{compression_ratio(Compressor(b''), validation):.2f} without")
+
+
+if __name__ == "__main__":
+    run()
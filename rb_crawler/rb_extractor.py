@@ -1,10 +1,12 @@
 import logging
 from time import sleep
+from typing import Optional
 
 import requests
 from parsel import Selector
 
 from build.gen.bakdata.corporate.v2.corporate_pb2 import Corporate, Status
+from rb_compression import Compressor
 from rb_producer import RbProducer
 
 from constant import State
@@ -13,13 +15,14 @@ log = logging.getLogger(__name__)
 
 
 class RbExtractor:
-    def __init__(self, start_rb_id: int, state: State, delay: float = 0.1, step: int = 1):
+    def __init__(self, start_rb_id: int, state: State, delay: float = 0.1, step: int = 1,
+                 compressor: Optional[Compressor] = None):
         self.rb_id = start_rb_id
         self.step = step
         self.state = state.value
         self.delay = delay
         self.slow = 0
-        self.producer = RbProducer()
+        self.producer = RbProducer(compressor)
 
     def extract_one(self):
         try:
@@ -12,6 +12,9 @@ import locale
 import json
 from tqdm import tqdm
 
+from instrumentation import instrumented, iterate, span, trace
+from rb_compression import DICTIONARIES, Decompressor
+
 no_match = 0
 
 
@@ -204,10 +207,17 @@ class Person:
 
 
 class RbParser:
-    def __init__(self, database):
+    def __init__(self, database, dictionaries=DICTIONARIES):
         self.db_conn: sqlite3.Connection = sqlite3.connect(database)
         self.db_conn.row_factory = sqlite3.Row
         self.db_cursor: sqlite3.Cursor = self.db_conn.cursor()
+        trace(self.db_conn)
+        self.decompressor = Decompressor(dictionaries)
+
+    def decompress(self, row: sqlite3.Row):
+        if row["information_compressed"] is None:
+            return row
+        return dict(row, information=self.decompressor.decompress(row["information_compressed"], row["dictionary_id"]))
 
     def run(self):
         total_lines = self.db_conn.execute("select count(*) from events").fetchone()[0]
@@ -215,7 +225,8 @@ class RbParser:
         current_company_id = -1
         current_company_events = []
         try:
-            for i, row in enumerate(tqdm(self.db_cursor, total=total_lines)):
+            for i, row in enumerate(tqdm(iterate("read", self.db_cursor), total=total_lines)):
+                row = self.decompress(row)
                 if row["company_id"] == current_company_id:
                     current_company_events.append(row)
                 else:
@@ -230,7 +241,8 @@ class RbParser:
 
     def tear_down(self):
         self.db_cursor.close()
-        self.db_conn.commit()
+        with span("commit"):
+            self.db_conn.commit()
         self.db_conn.close()
 
 
@@ -242,9 +254,11 @@ class CompanyParser:
         self.company_raw_events = company_raw_events
 
     def run(self):
-        for i, event in enumerate(self.company_raw_events):
-            self.parse_raw_event(event)
-        self.save()
+        with span("parse", rows=len(self.company_raw_events)):
+            for i, event in enumerate(self.company_raw_events):
+                self.parse_raw_event(event)
+        with span("write"):
+            self.save()
 
     def parse_raw_event(self, event: sqlite3.Row):
         if event["event_type"] == "delete":
@@ -399,8 +413,12 @@ class CompanyParser:
 
 @click.command()
 @click.option("-d", "--database", default="../data/corporate-new.sqlite", help="The sqlite database file to connect to")
-def run(database):
-    RbParser(database).run()
+@click.option("--dictionaries", default=str(DICTIONARIES), help="Directory of the dictionaries of compressed texts")
+@click.option("--instrument", type=click.Path(), default=None, help="Write a report of spans and SQL timings to this JSON file")
+@click.option("--profile", type=click.Path(), default=None, help="Write a sampling profile in folded format to this file")
+def run(database, dictionaries, instrument, profile):
+    with instrumented(instrument, profile):
+        RbParser(database, dictionaries).run()
 
 
 if __name__ == '__main__':
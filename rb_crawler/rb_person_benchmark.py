@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+from datetime import date, timedelta
+from typing import Dict, Iterator, List, Tuple
+
+import click
+
+from rb_person_deduplicator import InvalidDatesRemover, PersonEqualityDeduplicator, PersonFuzzyDeduplicator
+
+
+TRANSFORMATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "transformations")
+SCHEMA_SCRIPTS = ["3_create_persons.sql", "4_create_roles.sql", "6_allow_deleting_of_persons.sql"]
+
+FIRST_NAMES = [
+    "Alexander", "Andreas", "Anna", "Barbara", "Bernd", "Christian", "Christine", "Claudia", "Daniel", "Dieter",
+    "Elke", "Frank", "Gabriele", "Hans", "Heike", "Helmut", "Jörg", "Jürgen", "Karin", "Katrin", "Klaus", "Maria",
+    "Markus", "Martin", "Matthias", "Michael", "Monika", "Petra", "Peter", "Ralf", "Sabine", "Sebastian", "Stefan",
+    "Susanne", "Thomas", "Ursula", "Uwe", "Werner", "Wolfgang", "Günther",
+]
+LAST_NAMES = [
+    "Bauer", "Becker", "Braun", "Fischer", "Frank", "Fuchs", "Hahn", "Hartmann", "Hoffmann", "Hofmann", "Huber",
+    "Jung", "Kaiser", "Keller", "Klein", "Koch", "König", "Krause", "Krüger", "Lange", "Lehmann", "Maier", "Mayer",
+    "Meier", "Meyer", "Möller", "Müller", "Neumann", "Peters", "Richter", "Roth", "Schäfer", "Scholz", "Schmid",
+    "Schmidt", "Schmitt", "Schneider", "Schröder", "Schubert", "Schulte", "Schulz", "Schwarz", "Vogel", "Wagner",
+    "Walter", "Weber", "Weiß", "Werner", "Wolf", "Zimmermann",
+]
+BIRTH_PLACES = [
+    "Berlin", "Hamburg", "München", "Köln", "Frankfurt am Main", "Stuttgart", "Düsseldorf", "Leipzig", "Dortmund",
+    "Essen", "Bremen", "Dresden", "Hannover", "Nürnberg", "Duisburg", "Bochum", "Wuppertal", "Bielefeld", "Bonn",
+    "Münster", "Mannheim", "Karlsruhe", "Augsburg", "Wiesbaden", "Mönchengladbach", "Gelsenkirchen", "Aachen",
+    "Braunschweig", "Kiel", "Chemnitz", "Halle (Saale)", "Magdeburg", "Freiburg im Breisgau", "Krefeld", "Lübeck",
+]
+TRANSLITERATIONS = [("ä", "ae"), ("ö", "oe"), ("ü", "ue"), ("ß", "ss")]
+PLACE_ABBREVIATIONS = [(" am Main", " a.M."), (" im Breisgau", " i.Br."), (" (Saale)", "/Saale")]
+
+
+class SyntheticPersons:
+    """
+    Generates persons with known duplicates. Every entity is a real person; with probability duplicate_rate it is
+    announced one to three more times, and each of these announcements has a typo with probability typo_rate.
+    """
+
+    def __init__(self, duplicate_rate: float = 0.2, typo_rate: float = 0.5, seed: int = 42):
+        self.duplicate_rate = duplicate_rate
+        self.typo_rate = typo_rate
+        self.random = random.Random(seed)
+
+    def entity(self) -> Tuple[str, str, str, str]:
+        first_name = self.random.choice(FIRST_NAMES)
+        last_name = self.random.choice(LAST_NAMES)
+        if self.random.random() < 0.7:
+            # Double-barrelled and rare names, so that the name space grows with the number of persons
+            last_name = f"{last_name}-{self.random.choice(LAST_NAMES)}{self.random.randint(0, 99) or ''}"
+        birth_date = date(1930, 1, 1) + timedelta(days=self.random.randint(0, 70 * 365))
+        return first_name, last_name, birth_date.isoformat(), self.random.choice(BIRTH_PLACES)
+
+    def persons(self, count: int) -> Iterator[Tuple[int, str, str, str, str]]:
+        """Yields (entity_id, first_name, last_name, birth_date, birth_place) until count persons are generated."""
+        generated = 0
+        entity_id = 0
+        while generated < count:
+            entity_id += 1
+            person = self.entity()
+            announcements = 1
+            if self.random.random() < self.duplicate_rate:
+                announcements += self.random.randint(1, 3)
+            for i in range(min(announcements, count - generated)):
+                yield (entity_id, *(self.with_typo(person) if i > 0 and self.random.random() < self.typo_rate else person))
+                generated += 1
+
+    def with_typo(self, person: Tuple[str, str, str, str]) -> Tuple[str, str, str, str]:
+        first_name, last_name, birth_date, birth_place = person
+        typo = self.random.randrange(4)
+        if typo == 0:
+            first_name = self.name_variant(first_name, allow_second_name=True)
+        elif typo == 1:
+            last_name = self.name_variant(last_name)
+        elif typo == 2:
+            position = self.random.choice([2, 3, 6, 9])
+            digit = str((int(birth_date[position]) + self.random.choice([1, 9])) % 10)
+            birth_date = birth_date[:position] + digit + birth_date[position + 1:]
+        else:
+            birth_place = self.place_variant(birth_place)
+        return first_name, last_name, birth_date, birth_place
+
+    def name_variant(self, name: str, allow_second_name: bool = False) -> str:
+        if allow_second_name and self.random.random() < 0.25:
+            return f"{name} {self.random.choice(FIRST_NAMES)}"
+        if (transliterated := self.transliterate(name)) != name and self.random.random() < 0.5:
+            return transliterated
+        position = self.random.randrange(1, len(name) - 1)
+        variant = self.random.randrange(3)
+        if variant == 0:
+            # Swap two neighbouring characters
+            return name[:position] + name[position + 1] + name[position] + name[position + 2:]
+        if variant == 1:
+            return name[:position] + name[position + 1:]
+        return name[:position] + name[position] + name[position:]
+
+    def place_variant(self, place: str) -> str:
+        for long, short in PLACE_ABBREVIATIONS:
+            if long in place:
+                return place.replace(long, short)
+        if (transliterated := self.transliterate(place)) != place:
+            return transliterated
+        position = self.random.randrange(1, len(place))
+        return place[:position] + place[position + 1:]
+
+    @staticmethod
+    def transliterate(text: str) -> str:
+        for umlaut, replacement in TRANSLITERATIONS:
+            text = text.replace(umlaut, replacement)
+        return text
+
+
+def generate_database(database: str, persons: int, duplicate_rate: float, typo_rate: float, seed: int):
+    """
+    Creates persons and corporate_roles tables like the parser does, plus a benchmark_truth table with the entity of
+    every person. Each person gets a single corporate role in a company with the person's original id, so the
+    predicted cluster of a person can still be read from corporate_roles after the deduplication.
+    """
+    db_conn = sqlite3.connect(database)
+    for script in SCHEMA_SCRIPTS:
+        with open(os.path.join(TRANSFORMATIONS, script)) as file:
+            db_conn.executescript(file.read())
+    db_conn.execute("DROP TABLE IF EXISTS benchmark_truth")
+    db_conn.execute("CREATE TABLE benchmark_truth (person_id INTEGER PRIMARY KEY, entity_id INTEGER)")
+
+    generator = SyntheticPersons(duplicate_rate, typo_rate, seed)
+    for person_id, (entity_id, *person) in enumerate(generator.persons(persons), start=1):
+        db_conn.execute(
+            "INSERT INTO persons (id, first_name, last_name, birth_date, birth_location) VALUES (?, ?, ?, ?, ?)",
+            (person_id, *person)
+        )
+        db_conn.execute(
+            "INSERT INTO corporate_roles (company_id, person_id, role) VALUES (?, ?, 'MANAGER')",
+            (person_id, person_id)
+        )
+        db_conn.execute("INSERT INTO benchmark_truth VALUES (?, ?)", (person_id, entity_id))
+    db_conn.commit()
+    db_conn.close()
+
+
+def pairs(counts: Counter) -> int:
+    return sum(n * (n - 1) // 2 for n in counts.values())
+
+
+def precision_recall(database: str) -> Tuple[float, float]:
+    """Pairwise precision and recall of the clusters in corporate_roles compared to benchmark_truth."""
+    db_conn = sqlite3.connect(database)
+    rows = db_conn.execute(
+        "SELECT r.person_id, t.entity_id FROM corporate_roles r JOIN benchmark_truth t ON r.company_id = t.person_id"
+    ).fetchall()
+    db_conn.close()
+    true_positives = pairs(Counter(rows))
+    predicted = pairs(Counter(cluster for cluster, _ in rows))
+    actual = pairs(Counter(entity for _, entity in rows))
+    return true_positives / predicted if predicted else 1.0, true_positives / actual if actual else 1.0
+
+
+def _run_stage(stage, database, options, results):
+    executor = stage(database, **options)
+    start = time.perf_counter()
+    executor.run()
+    wall_time = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux; the scoring workers are included as children
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    results.put((wall_time, peak_rss * 1024, getattr(executor, "compared_pairs", 0)))
+
+
+def run_stage(stage, database: str, options: Dict) -> Tuple[float, int, int]:
+    """Runs a deduplication stage in its own process, so that its peak memory can be measured separately."""
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_stage, args=(stage, database, options, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def benchmark(database: str, persons: int, options: Dict) -> List[Dict]:
+    report = []
+    stages = [
+        ("invalid_dates", InvalidDatesRemover, {}),
+        ("equality", PersonEqualityDeduplicator, {}),
+        ("fuzzy", PersonFuzzyDeduplicator, options),
+    ]
+    for name, stage, stage_options in stages:
+        wall_time, peak_rss, compared_pairs = run_stage(stage, database, stage_options)
+        precision, recall = precision_recall(database)
+        report.append({
+            "persons": persons,
+            "stage": name,
+            "wall_time": wall_time,
+            "persons_per_second": persons / wall_time,
+            "compared_pairs": compared_pairs,
+            "pairs_per_second": compared_pairs / wall_time,
+            "peak_rss": peak_rss,
+            "precision": precision,
+            "recall": recall,
+        })
+    return report
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("-o", "--output", required=True, help="The sqlite database file to create")
+@click.option("-n", "--persons", type=int, default=100000, help="Number of persons to generate")
+@click.option("--duplicate-rate", type=float, default=0.2, help="Share of entities which are announced several times")
+@click.option("--typo-rate", type=float, default=0.5, help="Share of duplicate announcements with a typo")
+@click.option("--seed", type=int, default=42)
+def generate(output, persons, duplicate_rate, typo_rate, seed):
+    generate_database(output, persons, duplicate_rate, typo_rate, seed)
+
+
+@cli.command()
+@click.option("-s", "--sizes", default="100000,1000000,5000000", help="Comma separated numbers of persons")
+@click.option("--duplicate-rate", type=float, default=0.2, help="Share of entities which are announced several times")
+@click.option("--typo-rate", type=float, default=0.5, help="Share of duplicate announcements with a typo")
+@click.option("--seed", type=int, default=42)
+@click.option("--max-block-size", type=int, default=1000)
+@click.option("--window-size", type=int, default=20)
+@click.option("-w", "--workers", type=int, default=None)
+@click.option("-o", "--output", default=None, help="Write the report as JSON to this file")
+def run(sizes, duplicate_rate, typo_rate, seed, max_block_size, window_size, workers, output):
+    options = {"max_block_size": max_block_size, "window_size": window_size, "workers": workers}
+    report = []
+    directory = tempfile.mkdtemp(prefix="rb-person-benchmark-")
+    try:
+        for persons in map(int, sizes.split(",")):
+            database = os.path.join(directory, f"persons-{persons}.sqlite")
+            generate_database(database, persons, duplicate_rate, typo_rate, seed)
+            report += benchmark(database, persons, options)
+            os.remove(database)
+    finally:
+        shutil.rmtree(directory)
+
+    print(f"{'persons':>10} {'stage':<14} {'wall time':>10} {'pairs/s':>12} {'peak RSS':>10} {'precision':>10} {'recall':>8}")
+    for r in report:
+        print(
+            f"{r['persons']:>10} {r['stage']:<14} {r['wall_time']:>9.1f}s {r['pairs_per_second']:>12.0f} "
+            f"{r['peak_rss'] / 2 ** 20:>8.0f}MB {r['precision']:>10.4f} {r['recall']:>8.4f}"
+        )
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    cli()
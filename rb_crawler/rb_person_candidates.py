@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import dataclasses
+from bisect import bisect_left
+from typing import Callable, Dict, Hashable, Iterator, List, Sequence, Set, Tuple
+
+
+# Pairs are stored as a single integer (i << PAIR_SHIFT | j) instead of a tuple, which keeps the set of
+# candidate pairs considerably smaller for a few million persons
+PAIR_SHIFT = 32
+PAIR_MASK = (1 << PAIR_SHIFT) - 1
+
+
+@dataclasses.dataclass
+class CandidateStats:
+    blocks: int = 0
+    oversized_blocks: int = 0
+    largest_block: int = 0
+    generated_pairs: int = 0
+    new_pairs: int = 0
+
+    def __str__(self):
+        return (
+            f"{self.blocks} blocks ({self.oversized_blocks} oversized, largest {self.largest_block}), "
+            f"{self.generated_pairs} pairs generated, {self.new_pairs} new unique pairs"
+        )
+
+
+class CandidatePairGenerator:
+    """
+    Merges the candidate pairs of several blocking strategies into one set of unique pairs.
+
+    Blocks up to max_block_size are compared completely. Larger blocks (e.g. common first names) are split using
+    a sorted neighbourhood: the block is sorted by sort_key and each element is only paired with the next
+    window_size - 1 elements.
+
+    If first_new is given, only pairs with at least one record at or after that index are generated. This is used
+    to compare new records against already deduplicated ones without comparing the old records with each other.
+    """
+
+    def __init__(
+        self,
+        strategies: Dict[str, Callable[[object], Hashable]],
+        sort_key: Callable[[object], Hashable],
+        max_block_size: int = 1000,
+        window_size: int = 20,
+    ):
+        self.strategies = strategies
+        self.sort_key = sort_key
+        self.max_block_size = max_block_size
+        self.window_size = window_size
+        self.stats: Dict[str, CandidateStats] = {}
+
+    def generate(self, records: Sequence, first_new: int = 0) -> Set[int]:
+        pairs: Set[int] = set()
+        for name, strategy in self.strategies.items():
+            stats = CandidateStats()
+            size_before = len(pairs)
+            for block in self.blocks(records, strategy):
+                stats.blocks += 1
+                stats.largest_block = max(stats.largest_block, len(block))
+                if len(block) < 2:
+                    continue
+                if len(block) > self.max_block_size:
+                    stats.oversized_blocks += 1
+                    block = sorted(block, key=lambda i: self.sort_key(records[i]))
+                    stats.generated_pairs += self.add_window_pairs(pairs, block, first_new)
+                else:
+                    stats.generated_pairs += self.add_all_pairs(pairs, block, first_new)
+            stats.new_pairs = len(pairs) - size_before
+            self.stats[name] = stats
+        return pairs
+
+    @staticmethod
+    def blocks(records: Sequence, strategy: Callable[[object], Hashable]) -> Iterator[List[int]]:
+        groups: Dict[Hashable, List[int]] = {}
+        for i, record in enumerate(records):
+            groups.setdefault(strategy(record), []).append(i)
+        return iter(groups.values())
+
+    @staticmethod
+    def add_all_pairs(pairs: Set[int], block: List[int], first_new: int = 0) -> int:
+        # Block indices are ascending because records are enumerated in order, so every j is paired with all
+        # smaller indices of the block
+        generated = 0
+        for b in range(max(bisect_left(block, first_new), 1), len(block)):
+            j = block[b]
+            for i in block[:b]:
+                pairs.add(i << PAIR_SHIFT | j)
+            generated += b
+        return generated
+
+    def add_window_pairs(self, pairs: Set[int], block: List[int], first_new: int = 0) -> int:
+        generated = 0
+        for a, i in enumerate(block):
+            for j in block[a + 1:a + self.window_size]:
+                if i < first_new and j < first_new:
+                    continue
+                pairs.add(i << PAIR_SHIFT | j if i < j else j << PAIR_SHIFT | i)
+                generated += 1
+        return generated
+
+    @staticmethod
+    def decode(pair: int) -> Tuple[int, int]:
+        return pair >> PAIR_SHIFT, pair & PAIR_MASK
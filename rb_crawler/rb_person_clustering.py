@@ -0,0 +1,35 @@
+from typing import Dict, Iterator, Tuple
+
+
+class DisjointSet:
+    """
+    Union-find over person ids with path compression. The smallest id of a cluster is its representative, so the
+    oldest person entry is kept, same as for the equality deduplication.
+    """
+
+    def __init__(self):
+        self.parent: Dict[int, int] = {}
+
+    def find(self, x: int) -> int:
+        root = x
+        while (parent := self.parent.get(root, root)) != root:
+            root = parent
+        # Path compression: let every element on the way point directly to the root
+        while x != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a: int, b: int) -> int:
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return root_a
+        root, child = min(root_a, root_b), max(root_a, root_b)
+        self.parent[child] = root
+        self.parent.setdefault(root, root)
+        return root
+
+    def mapping(self) -> Iterator[Tuple[int, int]]:
+        """Yields (duplicate_id, main_id) for every element which is not the representative of its cluster."""
+        for x in list(self.parent):
+            if (root := self.find(x)) != x:
+                yield x, root
@@ -1,77 +1,32 @@
 from __future__ import annotations
 
 import sqlite3
+from pathlib import Path
 
 import click
-import dataclasses
 import logging
 from tqdm import tqdm
-from typing import List
-from Levenshtein import distance, jaro_winkler
+from typing import Iterable, Tuple
 
-
-@dataclasses.dataclass
-class Person:
-    id: int = None
-    first_name: str = None
-    last_name: str = None
-    birth_date: str = None
-    birth_place: str = None
-    deleted: int = 0
-    duplicates: List[Person] = dataclasses.field(default_factory=list)
-    visited: bool = False
-
-    def first_name_similiary(self, other_person: Person):
-        return jaro_winkler(self.first_name, other_person.first_name)
-
-    def last_name_similiary(self, other_person: Person):
-        return jaro_winkler(self.last_name, other_person.last_name)
-
-    def place_similarity(self, other_person: Person):
-        return jaro_winkler(self.birth_place, other_person.birth_place)
-
-    def is_similar(self, other_person: Person):
-        if distance(self.birth_date, other_person.birth_date) > 1:
-            return False
-
-        first_name_dist = jaro_winkler(self.first_name, other_person.first_name)
-        if first_name_dist < 0.94 \
-            and self.first_name not in other_person.first_name and other_person.first_name not in self.first_name:
-            return False
-
-        if jaro_winkler(self.last_name, other_person.last_name) < 0.94:
-            return False
-
-        if jaro_winkler(self.birth_place, other_person.birth_place) < 0.90:
-            return False
-
-        return True
-
-    def add_duplicate(self, other_person: Person):
-        if other_person not in self.duplicates:
-            self.duplicates.append(other_person)
-
-    def transitive_hull(self):
-        hull = []
-        for duplicate in self.duplicates:
-            h = duplicate.transitive_hull()
-            for d in h:
-                if d not in hull:
-                    hull.append(d)
-        self.duplicates = hull
-        self.visited = True
-        return hull + [self]
+from instrumentation import instrumented, span, trace
+from rb_person_candidates import CandidatePairGenerator
+from rb_person_clustering import DisjointSet
+from rb_person_scoring import SCORING_BACKEND, PersonRecord, PersonStore, SimilarityScorer
 
 
 class SQLExecutor:
     def __init__(self, database):
-        self.db_conn: sqlite3.Connection = sqlite3.connect(database)
+        # LEI matching may write to the same database concurrently (see pipeline.py), so wait for its locks.
+        # Transactions take the write lock when they begin, as one which already read cannot wait for another writer.
+        self.db_conn: sqlite3.Connection = sqlite3.connect(database, timeout=600, isolation_level="IMMEDIATE")
         # self.db_conn.set_trace_callback(print)
         self.db_conn.row_factory = sqlite3.Row
+        trace(self.db_conn)
 
     def run(self):
         try:
-            self.execute_queries()
+            with span(type(self).__name__):
+                self.execute_queries()
         finally:
             self.db_conn.commit()
             self.db_conn.close()
@@ -79,49 +34,107 @@ class SQLExecutor:
     def execute_queries(self):
         pass
 
+    def create_person_mapping(self, mapping: Iterable[Tuple[int, int]] = ()):
+        """
+        Creates the temporary person_mapping table of (duplicate_id, main_id) rows. Deduplicators fill it either
+        from Python or directly with an INSERT ... SELECT and then apply it with apply_person_mapping.
+        """
+        self.db_conn.execute("DROP TABLE IF EXISTS temp.person_mapping")
+        self.db_conn.execute(
+            "CREATE TEMPORARY TABLE person_mapping (duplicate_id INTEGER PRIMARY KEY, main_id INTEGER NOT NULL)"
+        )
+        self.db_conn.executemany("INSERT INTO person_mapping VALUES (?, ?)", mapping)
+
+    def apply_person_mapping(self) -> int:
+        # The related companies of the companies of duplicates and their main persons change, see
+        # RelatedCompaniesRefresher. Kept in a table, as every deduplicator has its own connection.
+        self.db_conn.execute("CREATE TABLE IF NOT EXISTS changed_companies (company_id INTEGER PRIMARY KEY)")
+        self.db_conn.execute(
+            "INSERT OR IGNORE INTO changed_companies "
+            "SELECT company_id FROM corporate_roles "
+            "WHERE person_id IN (SELECT duplicate_id FROM person_mapping UNION SELECT main_id FROM person_mapping)"
+        )
+        # Both updates are single set-based statements instead of one statement per duplicate
+        self.db_conn.execute(
+            "UPDATE corporate_roles "
+            "SET person_id = (SELECT main_id FROM person_mapping WHERE duplicate_id = corporate_roles.person_id) "
+            "WHERE person_id IN (SELECT duplicate_id FROM person_mapping)"
+        )
+        return self.db_conn.execute(
+            "UPDATE persons SET deleted = 1 WHERE id IN (SELECT duplicate_id FROM person_mapping)"
+        ).rowcount
+
+def last_deduplicated_person(database) -> int:
+    """The largest person id of the last incremental run, persons after it are new."""
+    db_conn = sqlite3.connect(database)
+    try:
+        return db_conn.execute("SELECT coalesce(max(last_person_id), 0) FROM person_dedup_state").fetchone()[0]
+    except sqlite3.OperationalError:
+        # No incremental run yet
+        return 0
+    finally:
+        db_conn.close()
+
 class InvalidDatesRemover(SQLExecutor):
+    def __init__(self, database, after_person_id=0):
+        super().__init__(database)
+        self.after_person_id = after_person_id
+
     def execute_queries(self):
         # There are only a few hundred of those, so don't worry about trying to correct them
-        self.db_conn.execute("UPDATE persons SET birth_date = null WHERE birth_date < '1800'")
+        self.db_conn.execute(
+            "UPDATE persons SET birth_date = null WHERE birth_date < '1800' AND id > ?", (self.after_person_id,)
+        )
 
 class PersonEqualityDeduplicator(SQLExecutor):
+    # Single grouped pass: every person is mapped to the smallest id with equal name, birth date and birth location
     DUPLICATE_PERSONS_QUERY = (
-        "SELECT min(p1.id) as main_entity_id, p2.id as duplicate_id, p2.first_name, p2.last_name, p2.birth_date, p2.birth_location "
-        "FROM persons p1, persons p2 "
-        "WHERE "
-        "    p1.deleted = 0 AND p2.deleted = 0"
-        "  AND p1.birth_date is not null "
-        "  AND p1.id < p2.id "
-        "  AND p1.first_name = p2.first_name "
-        "  AND p1.last_name = p2.last_name "
-        "  AND p1.birth_date = p2.birth_date "
-        "  AND p1.birth_location = p2.birth_location "
-        "GROUP BY p2.id, p2.first_name, p2.last_name, p2.birth_date, p2.birth_location"
+        "SELECT id AS duplicate_id, main_entity_id FROM ("
+        "   SELECT id, min(id) OVER (PARTITION BY first_name, last_name, birth_date, birth_location) AS main_entity_id "
+        "   FROM persons "
+        "   WHERE deleted = 0 "
+        "   AND first_name IS NOT NULL AND last_name IS NOT NULL "
+        "   AND birth_date IS NOT NULL AND birth_location IS NOT NULL"
+        ") "
+        "WHERE id != main_entity_id"
+    )
+    # Only the new persons, mapped to the smallest id of an equal existing or new person, which is found in the
+    # persons_identity index instead of partitioning all persons
+    NEW_DUPLICATE_PERSONS_QUERY = (
+        "SELECT id AS duplicate_id, main_entity_id FROM ("
+        "   SELECT n.id, ("
+        "       SELECT min(p.id) FROM persons p "
+        "       WHERE p.last_name = n.last_name AND p.first_name = n.first_name "
+        "       AND p.birth_date = n.birth_date AND p.birth_location = n.birth_location AND p.deleted = 0"
+        "   ) AS main_entity_id "
+        "   FROM persons n "
+        "   WHERE n.id > ? AND n.deleted = 0 "
+        "   AND n.first_name IS NOT NULL AND n.last_name IS NOT NULL "
+        "   AND n.birth_date IS NOT NULL AND n.birth_location IS NOT NULL"
+        ") "
+        "WHERE id != main_entity_id"
     )
 
-    def execute_queries(self):
-        # Create index on person_id so that each update query does not have to scan the table to find the correct id
-        self.db_conn.execute(
-            "CREATE INDEX IF NOT EXISTS corporate_roles_id "
-            "ON corporate_roles(person_id)"
-        )
-        total_lines = self.db_conn.execute(f"SELECT count(*) FROM ({self.DUPLICATE_PERSONS_QUERY})").fetchone()[0]
-        query_cursor = self.db_conn.execute(self.DUPLICATE_PERSONS_QUERY)
-        update_cursor = self.db_conn.cursor()
-        ids_to_delete = []
-        for row in tqdm(query_cursor, total=total_lines):
-            # Map all corporate roles of duplicate person to the same person
-            update_cursor.execute(
-                "UPDATE corporate_roles "
-                "SET person_id = ? "
-                "WHERE person_id = ?",
-                (row["main_entity_id"], row["duplicate_id"])
-            )
-            ids_to_delete.append(str(row["duplicate_id"]))
+    def __init__(self, database, after_person_id=None):
+        super().__init__(database)
+        self.after_person_id = after_person_id
 
-        # Delete duplicate persons
-        self.db_conn.set_trace_callback(print)
-        self.db_conn.execute(f"UPDATE persons SET deleted = 1 WHERE id IN ({','.join(ids_to_delete)})")
+    def execute_queries(self):
+        with span("write") as write:
+            self.create_person_mapping()
+            if self.after_person_id is None:
+                self.db_conn.execute(f"INSERT INTO person_mapping {self.DUPLICATE_PERSONS_QUERY}")
+            else:
+                # Built over all persons by the first incremental run only, afterwards it is kept up to date
+                self.db_conn.execute(
+                    "CREATE INDEX IF NOT EXISTS persons_identity "
+                    "ON persons(last_name, first_name, birth_date, birth_location, deleted)"
+                )
+                self.db_conn.execute(
+                    f"INSERT INTO person_mapping {self.NEW_DUPLICATE_PERSONS_QUERY}", (self.after_person_id,)
+                )
+            deleted = write.rows = self.apply_person_mapping()
+        print(f"{deleted} persons merged into an equal person")
 
 class PersonFuzzyDeduplicator(SQLExecutor):
     PERSONS_QUERY = (
@@ -136,71 +149,253 @@ class PersonFuzzyDeduplicator(SQLExecutor):
     # Für 1 Partition: 67 Minuten
     # Unter der Annahme, dass ein Vergleich höchstens 3CPU-Takte braucht, ist also vermutlich Faktor 100 höher...
 
-    def group_by1(self, person: Person):
+    def __init__(self, database, max_block_size=1000, window_size=20, workers=None):
+        super().__init__(database)
+        self.max_block_size = max_block_size
+        self.window_size = window_size
+        self.workers = workers
+        self.compared_pairs = 0
+
+    def group_by1(self, person: PersonRecord):
         return person.first_name[:3] + person.last_name[-3:] + person.last_name[3:]
 
-    def group_by2(self, person: Person):
+    def group_by2(self, person: PersonRecord):
         return person.last_name[:4] + person.birth_date[2:7]
 
-    def group_by3(self, person: Person):
+    def group_by3(self, person: PersonRecord):
         return person.birth_date[-5:] + person.first_name[-3:]
 
-    def group_by4(self, person: Person):
+    def group_by4(self, person: PersonRecord):
         return person.birth_date[2:7] + person.first_name[3:]
 
+    @staticmethod
+    def sort_key(person: PersonRecord):
+        return person.last_name, person.first_name, person.birth_date
+
+    def strategies(self):
+        return {
+            "group_by1": self.group_by1,
+            "group_by2": self.group_by2,
+            "group_by3": self.group_by3,
+            "group_by4": self.group_by4,
+        }
+
+    def candidate_generator(self):
+        return CandidatePairGenerator(
+            self.strategies(),
+            self.sort_key,
+            max_block_size=self.max_block_size,
+            window_size=self.window_size,
+        )
+
+    def find_clusters(self, store: PersonStore, first_new: int = 0) -> DisjointSet:
+        candidates = self.candidate_generator()
+        with span("block", rows=len(store)):
+            pairs = candidates.generate(store, first_new=first_new)
+        self.compared_pairs += len(pairs)
+        for name, stats in candidates.stats.items():
+            tqdm.write(f"{name}: {stats}")
+
+        # Each pair is compared exactly once, even if several groupings put both persons into the same block
+        clusters = DisjointSet()
+        tqdm.write(f"Scoring {len(pairs)} pairs with {SCORING_BACKEND}")
+        with span("score", rows=len(pairs)):
+            for i, j in tqdm(SimilarityScorer(store, workers=self.workers).matches(pairs)):
+                clusters.union(store.ids[i], store.ids[j])
+        return clusters
+
     def execute_queries(self):
         # As there are quite a lot of cases where persons have the name but different birth dates/places, we cannot
         # reliably match the persons where one of those is missing
-        query_cursor = self.db_conn.execute(self.PERSONS_QUERY)
-        total_lines = self.db_conn.execute(f"SELECT count(*) FROM ({self.PERSONS_QUERY})").fetchone()[0]
-        groupings = [self.group_by1, self.group_by2, self.group_by3, self.group_by4]
-        persons = []
-        person_groups = [{} for _ in groupings]
-
-        for row in tqdm(query_cursor, total=total_lines):
-            person = Person(*row)
-            persons.append(person)
-            for i, grouping in enumerate(groupings):
-                if grouping(person) not in person_groups[i]:
-                    person_groups[i][grouping(person)] = [person]
-                else:
-                    person_groups[i][grouping(person)].append(person)
-
-        for person_grouping in person_groups:
-            for person_group in tqdm(sorted(person_grouping.values(), key=len, reverse=True)):
-                for i, person1 in enumerate(person_group):
-                    for j in range(i + 1, len(person_group)):
-                        person2 = person_group[j]
-                        if person1.is_similar(person2):
-                            person1.add_duplicate(person2)
-
-        update_cursor = self.db_conn.cursor()
-        ids_to_delete = []
-        for person in persons:
-            if not person.visited:
-                person.transitive_hull()
-                if len(person.duplicates) == 0:
-                    continue
-                # Map all corporate roles of duplicate person to the same person
-                duplicate_ids = list(map(lambda p: str(p.id), person.duplicates))
-                update_cursor.execute(
-                    "UPDATE corporate_roles "
-                    f"SET person_id = {person.id} "
-                    f"WHERE person_id IN ({','.join(duplicate_ids)})",
+        with span("read") as read:
+            query_cursor = self.db_conn.execute(self.PERSONS_QUERY)
+            total_lines = self.db_conn.execute(f"SELECT count(*) FROM ({self.PERSONS_QUERY})").fetchone()[0]
+            store = PersonStore.from_rows(tqdm(query_cursor, total=total_lines))
+            read.rows = len(store)
+
+        clusters = self.find_clusters(store)
+        with span("write") as write:
+            self.create_person_mapping(clusters.mapping())
+            deleted = write.rows = self.apply_person_mapping()
+        tqdm.write(f"{deleted} persons merged into a similar person")
+
+
+class IncrementalPersonDeduplicator(PersonFuzzyDeduplicator):
+    """
+    Only blocks and scores the persons inserted since the last run. They are compared with each other and with the
+    cluster representatives which share a block key in the persisted person_blocks index. If a new person links
+    several clusters, these are merged into the cluster with the smallest representative id.
+    """
+
+    def create_tables(self):
+        self.db_conn.execute("CREATE TABLE IF NOT EXISTS person_dedup_state (last_person_id INTEGER)")
+        self.db_conn.execute(
+            "CREATE TABLE IF NOT EXISTS person_clusters (person_id INTEGER PRIMARY KEY, cluster_id INTEGER NOT NULL)"
+        )
+        self.db_conn.execute("CREATE INDEX IF NOT EXISTS person_clusters_cluster_id ON person_clusters(cluster_id)")
+        # Only representatives (i.e. persons which are not deleted) are kept in the blocking index
+        self.db_conn.execute("CREATE TABLE IF NOT EXISTS person_blocks (strategy TEXT, block_key TEXT, person_id INTEGER)")
+        self.db_conn.execute("CREATE INDEX IF NOT EXISTS person_blocks_key ON person_blocks(strategy, block_key)")
+        self.db_conn.execute("CREATE INDEX IF NOT EXISTS person_blocks_person_id ON person_blocks(person_id)")
+
+    def execute_queries(self):
+        self.create_tables()
+        last_person_id = self.db_conn.execute("SELECT coalesce(max(last_person_id), 0) FROM person_dedup_state").fetchone()[0]
+        max_person_id = self.db_conn.execute("SELECT coalesce(max(id), 0) FROM persons").fetchone()[0]
+        with span("read") as read:
+            new_persons = PersonStore.from_rows(
+                self.db_conn.execute(f"{self.PERSONS_QUERY} AND id > ? AND id <= ?", (last_person_id, max_person_id))
+            )
+            read.rows = len(new_persons)
+        tqdm.write(f"{len(new_persons)} new persons since person {last_person_id}")
+
+        with span("index", rows=len(new_persons)):
+            self.db_conn.execute("DROP TABLE IF EXISTS temp.new_person_blocks")
+            self.db_conn.execute(
+                "CREATE TEMPORARY TABLE new_person_blocks (strategy TEXT, block_key TEXT, person_id INTEGER)"
+            )
+            self.db_conn.executemany(
+                "INSERT INTO new_person_blocks VALUES (?, ?, ?)",
+                (
+                    (name, strategy(new_persons[i]), new_persons.ids[i])
+                    for i in range(len(new_persons))
+                    for name, strategy in self.strategies().items()
                 )
-                ids_to_delete += duplicate_ids
+            )
 
-        # Delete duplicate persons
-        self.db_conn.set_trace_callback(print)
-        self.db_conn.execute(f"UPDATE persons SET deleted = 1 WHERE id IN ({','.join(ids_to_delete)})")
+        # Representatives come first in the store, so that only pairs with at least one new person are generated
+        with span("read") as read:
+            store = PersonStore.from_rows(self.db_conn.execute(
+                "SELECT * FROM persons "
+                "WHERE deleted = 0 AND id IN ("
+                "   SELECT b.person_id "
+                "   FROM person_blocks b "
+                "   JOIN new_person_blocks n ON b.strategy = n.strategy AND b.block_key = n.block_key"
+                ") "
+                "ORDER BY id"
+            ))
+            read.rows = len(store)
+        first_new = len(store)
+        for i in range(len(new_persons)):
+            store.append(*new_persons[i])
+        tqdm.write(f"{first_new} existing cluster representatives share a block with a new person")
+
+        clusters = self.find_clusters(store, first_new=first_new)
+        with span("write") as write:
+            self.create_person_mapping(clusters.mapping())
+            deleted = write.rows = self.apply_person_mapping()
+            tqdm.write(f"{deleted} persons merged into a similar person")
+
+            # Members of clusters whose representative was merged into another cluster move along
+            self.db_conn.execute(
+                "UPDATE person_clusters "
+                "SET cluster_id = (SELECT main_id FROM person_mapping WHERE duplicate_id = person_clusters.cluster_id) "
+                "WHERE cluster_id IN (SELECT duplicate_id FROM person_mapping)"
+            )
+            self.db_conn.executemany(
+                "INSERT OR REPLACE INTO person_clusters VALUES (?, ?)",
+                ((person_id, clusters.find(person_id)) for person_id in new_persons.ids)
+            )
+            self.db_conn.execute(
+                "DELETE FROM person_blocks WHERE person_id IN (SELECT duplicate_id FROM person_mapping)"
+            )
+            self.db_conn.execute(
+                "INSERT INTO person_blocks "
+                "SELECT * FROM new_person_blocks WHERE person_id NOT IN (SELECT duplicate_id FROM person_mapping)"
+            )
+            self.db_conn.execute("DELETE FROM person_dedup_state")
+            self.db_conn.execute("INSERT INTO person_dedup_state VALUES (?)", (max_person_id,))
+
+
+class RelatedCompaniesRefresher(SQLExecutor):
+    """
+    The related companies are derived from the active roles of the persons, which the deduplicators just merged.
+    Incremental runs only recompute the pairs of changed companies: those of the merged persons (recorded by
+    apply_person_mapping) and those with roles of the new persons.
+    """
+    SCRIPT = Path(__file__).resolve().parent.parent / "transformations" / "8_create_related_companies.sql"
+    # Every pair of companies with an active person in common is stored in both directions, so the pairs of a
+    # changed company are found by its own rows
+    DELETE_CHANGED_PAIRS = [
+        "DELETE FROM related_companies WHERE (company_id, related_id) IN ("
+        "   SELECT related_id, company_id FROM related_companies "
+        "   WHERE company_id IN (SELECT company_id FROM changed_companies)"
+        ")",
+        "DELETE FROM related_companies WHERE company_id IN (SELECT company_id FROM changed_companies)",
+    ]
+    # Like transformations/8_create_related_companies.sql, but only for the persons of changed companies, which are
+    # all persons a pair with a changed company can have in common
+    INSERT_CHANGED_PAIRS = (
+        "INSERT INTO related_companies "
+        "WITH changed_persons AS ("
+        "   SELECT DISTINCT person_id FROM corporate_roles "
+        "   WHERE active = 1 AND company_id IN (SELECT company_id FROM changed_companies)"
+        ") "
+        "SELECT "
+        "   own.company_id, "
+        "   related.company_id, "
+        "   COUNT(DISTINCT p.id), "
+        "   GROUP_CONCAT(p.last_name || ', ' || p.first_name || ' (' || related.role || ')', ', ') "
+        "FROM "
+        "   (SELECT DISTINCT company_id, person_id FROM corporate_roles "
+        "    WHERE active = 1 AND person_id IN changed_persons) own "
+        "   JOIN corporate_roles related ON related.person_id = own.person_id "
+        "   JOIN persons p ON p.id = own.person_id "
+        "WHERE "
+        "   related.active = 1 "
+        "   AND related.company_id != own.company_id "
+        "   AND (own.company_id IN (SELECT company_id FROM changed_companies) "
+        "        OR related.company_id IN (SELECT company_id FROM changed_companies)) "
+        "GROUP BY own.company_id, related.company_id"
+    )
+
+    def __init__(self, database, after_person_id=None):
+        super().__init__(database)
+        self.after_person_id = after_person_id
+
+    def execute_queries(self):
+        exists = self.db_conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'related_companies'"
+        ).fetchone()
+        if not self.after_person_id or exists is None:
+            self.db_conn.executescript(self.SCRIPT.read_text())
+            self.db_conn.execute("DROP TABLE IF EXISTS changed_companies")
+        else:
+            self.db_conn.execute("CREATE TABLE IF NOT EXISTS changed_companies (company_id INTEGER PRIMARY KEY)")
+            self.db_conn.execute(
+                "INSERT OR IGNORE INTO changed_companies SELECT company_id FROM corporate_roles WHERE person_id > ?",
+                (self.after_person_id,)
+            )
+            changed = self.db_conn.execute("SELECT COUNT(*) FROM changed_companies").fetchone()[0]
+            with span("write", rows=changed):
+                for statement in self.DELETE_CHANGED_PAIRS:
+                    self.db_conn.execute(statement)
+                self.db_conn.execute(self.INSERT_CHANGED_PAIRS)
+                self.db_conn.execute("DELETE FROM changed_companies")
+            print(f"Related companies of {changed} changed companies refreshed")
+        count = self.db_conn.execute("SELECT COUNT(*) FROM related_companies").fetchone()[0]
+        print(f"{count} related company pairs")
 
 
 @click.command()
 @click.option("-d", "--database", default="../data/corporate-new.sqlite", help="The sqlite database file to connect to")
-def run(database):
-    InvalidDatesRemover(database).run()
-    PersonEqualityDeduplicator(database).run()
-    PersonFuzzyDeduplicator(database).run()
+@click.option("--max-block-size", type=int, default=1000, help="Blocks larger than this are split by a sorted neighbourhood")
+@click.option("--window-size", type=int, default=20, help="Window of the sorted neighbourhood for oversized blocks")
+@click.option("-w", "--workers", type=int, default=None, help="Number of processes scoring candidate pairs (default: all cores)")
+@click.option("--incremental", is_flag=True,
+              help="Only clean, deduplicate and relate the persons inserted since the last incremental run. "
+                   "The first one builds an index over all persons and compares all of them.")
+@click.option("--instrument", type=click.Path(), default=None, help="Write a report of spans and SQL timings to this JSON file")
+@click.option("--profile", type=click.Path(), default=None, help="Write a sampling profile in folded format to this file")
+def run(database, max_block_size, window_size, workers, incremental, instrument, profile):
+    with instrumented(instrument, profile):
+        # Read before the incremental deduplicator moves it
+        after_person_id = last_deduplicated_person(database) if incremental else None
+        InvalidDatesRemover(database, after_person_id or 0).run()
+        PersonEqualityDeduplicator(database, after_person_id).run()
+        fuzzy_deduplicator = IncrementalPersonDeduplicator if incremental else PersonFuzzyDeduplicator
+        fuzzy_deduplicator(database, max_block_size=max_block_size, window_size=window_size, workers=workers).run()
+        RelatedCompaniesRefresher(database, after_person_id).run()
 
 
 if __name__ == '__main__':
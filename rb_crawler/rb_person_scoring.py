@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import multiprocessing
+import sys
+from array import array
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from Levenshtein import distance, jaro_winkler
+
+from rb_person_candidates import PAIR_MASK, PAIR_SHIFT
+
+try:
+    # Optional (poetry install --extras fast-scoring): scores whole batches of pairs natively instead of one Python
+    # call per pair and attribute
+    import numpy as np
+    from rapidfuzz.distance import JaroWinkler
+    from rapidfuzz.distance import Levenshtein as LevenshteinDistance
+    from rapidfuzz.process import cpdist
+except ImportError:
+    cpdist = None
+
+SCORING_BACKEND = "rapidfuzz (batched)" if cpdist is not None else "python-Levenshtein (per pair)"
+
+
+FIRST_NAME_THRESHOLD = 0.94
+LAST_NAME_THRESHOLD = 0.94
+BIRTH_PLACE_THRESHOLD = 0.90
+MAX_BIRTH_DATE_DISTANCE = 1
+
+
+class PersonRecord(NamedTuple):
+    id: int
+    first_name: str
+    last_name: str
+    birth_date: str
+    birth_place: str
+
+
+class PersonStore:
+    """
+    Columnar storage of the persons to deduplicate. Strings are interned, as first names, birth places and
+    birth dates repeat a lot, and no object is kept per person.
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.first_names: List[str] = []
+        self.last_names: List[str] = []
+        self.birth_dates: List[str] = []
+        self.birth_places: List[str] = []
+
+    @classmethod
+    def from_rows(cls, rows: Iterable) -> PersonStore:
+        store = cls()
+        for row in rows:
+            store.append(row["id"], row["first_name"], row["last_name"], row["birth_date"], row["birth_location"])
+        return store
+
+    def append(self, person_id, first_name, last_name, birth_date, birth_place):
+        self.ids.append(person_id)
+        self.first_names.append(sys.intern(first_name))
+        self.last_names.append(sys.intern(last_name))
+        self.birth_dates.append(sys.intern(birth_date))
+        self.birth_places.append(sys.intern(birth_place))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i) -> PersonRecord:
+        return PersonRecord(
+            self.ids[i], self.first_names[i], self.last_names[i], self.birth_dates[i], self.birth_places[i]
+        )
+
+
+def is_similar(store: PersonStore, i: int, j: int) -> bool:
+    if distance(store.birth_dates[i], store.birth_dates[j]) > MAX_BIRTH_DATE_DISTANCE:
+        return False
+
+    first_name1, first_name2 = store.first_names[i], store.first_names[j]
+    if jaro_winkler(first_name1, first_name2) < FIRST_NAME_THRESHOLD \
+            and first_name1 not in first_name2 and first_name2 not in first_name1:
+        return False
+
+    if jaro_winkler(store.last_names[i], store.last_names[j]) < LAST_NAME_THRESHOLD:
+        return False
+
+    if jaro_winkler(store.birth_places[i], store.birth_places[j]) < BIRTH_PLACE_THRESHOLD:
+        return False
+
+    return True
+
+
+def score_batch(store: PersonStore, batch: array) -> List[int]:
+    """Returns the encoded pairs of the batch which are similar according to the thresholds above."""
+    lefts = [pair >> PAIR_SHIFT for pair in batch]
+    rights = [pair & PAIR_MASK for pair in batch]
+    if cpdist is None:
+        return [pair for pair, i, j in zip(batch, lefts, rights) if is_similar(store, i, j)]
+
+    def column(values):
+        return [values[i] for i in lefts], [values[j] for j in rights]
+
+    first_names1, first_names2 = column(store.first_names)
+    mask = cpdist(*column(store.birth_dates), scorer=LevenshteinDistance.distance) <= MAX_BIRTH_DATE_DISTANCE
+    mask &= cpdist(*column(store.last_names), scorer=JaroWinkler.similarity) >= LAST_NAME_THRESHOLD
+    mask &= cpdist(*column(store.birth_places), scorer=JaroWinkler.similarity) >= BIRTH_PLACE_THRESHOLD
+    mask &= (cpdist(first_names1, first_names2, scorer=JaroWinkler.similarity) >= FIRST_NAME_THRESHOLD) | np.fromiter(
+        (a in b or b in a for a, b in zip(first_names1, first_names2)), dtype=bool, count=len(batch)
+    )
+    return [batch[k] for k in np.flatnonzero(mask)]
+
+
+# Set in each worker process by the pool initializer, so the store is transferred once and not with every batch
+_worker_store: Optional[PersonStore] = None
+
+
+def _init_worker(store: PersonStore):
+    global _worker_store
+    _worker_store = store
+
+
+def _score_worker_batch(batch: array) -> List[int]:
+    return score_batch(_worker_store, batch)
+
+
+class SimilarityScorer:
+    def __init__(self, store: PersonStore, workers: int = None, batch_size: int = 50000):
+        self.store = store
+        self.workers = workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+
+    def batches(self, pairs: Iterable[int]) -> Iterator[array]:
+        batch = array("Q")
+        for pair in pairs:
+            batch.append(pair)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = array("Q")
+        if len(batch) != 0:
+            yield batch
+
+    def matches(self, pairs: Iterable[int]) -> Iterator[Tuple[int, int]]:
+        """Scores the encoded candidate pairs in batches and yields the decoded (i, j) pairs of similar persons."""
+        if self.workers == 1:
+            results = (score_batch(self.store, batch) for batch in self.batches(pairs))
+            yield from self.decode(results)
+            return
+        with multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(self.store,)) as pool:
+            yield from self.decode(pool.imap_unordered(_score_worker_batch, self.batches(pairs)))
+
+    @staticmethod
+    def decode(results: Iterable[List[int]]) -> Iterator[Tuple[int, int]]:
+        for matching_pairs in results:
+            for pair in matching_pairs:
+                yield pair >> PAIR_SHIFT, pair & PAIR_MASK
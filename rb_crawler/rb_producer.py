@@ -1,4 +1,5 @@
 import logging
+from typing import Optional
 
 from confluent_kafka import SerializingProducer
 from confluent_kafka.schema_registry import SchemaRegistryClient
@@ -8,12 +9,14 @@ from confluent_kafka.serialization import StringSerializer
 from build.gen.bakdata.corporate.v2 import corporate_pb2
 from build.gen.bakdata.corporate.v2.corporate_pb2 import Corporate
 from rb_crawler.constant import SCHEMA_REGISTRY_URL, BOOTSTRAP_SERVER, TOPIC
+from rb_crawler.rb_compression import Compressor
 
 log = logging.getLogger(__name__)
 
 
 class RbProducer:
-    def __init__(self):
+    def __init__(self, compressor: Optional[Compressor] = None):
+        self.compressor = compressor
         schema_registry_conf = {"url": SCHEMA_REGISTRY_URL}
         schema_registry_client = SchemaRegistryClient(schema_registry_conf)
 
@@ -29,7 +32,18 @@ class RbProducer:
 
         self.producer = SerializingProducer(producer_conf)
 
+    def compress(self, corporate: Corporate):
+        """Replaces the information by its compressed form, unless that is not shorter (e.g. for very short texts)."""
+        if self.compressor is None or not corporate.information:
+            return
+        compressed = self.compressor.compress(corporate.information)
+        if len(compressed) < len(corporate.information.encode()):
+            corporate.information_compressed = compressed
+            corporate.dictionary_id = self.compressor.dictionary_id
+            corporate.ClearField("information")
+
     def produce_to_topic(self, corporate: Corporate):
+        self.compress(corporate)
         self.producer.produce(
             topic=TOPIC, partition=-1, key=str(corporate.id), value=corporate, on_delivery=self.delivery_report
         )
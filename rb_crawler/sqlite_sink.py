@@ -0,0 +1,193 @@
+import logging
+import os
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from typing import Iterable, Optional
+
+import click
+from confluent_kafka import Consumer, KafkaException, Message
+from confluent_kafka.schema_registry.protobuf import ProtobufDeserializer
+from confluent_kafka.serialization import MessageField, SerializationContext
+from google.protobuf.descriptor import FieldDescriptor
+
+from build.gen.bakdata.corporate.v2.corporate_pb2 import Corporate
+from build.gen.lei.v1.leidata_pb2 import LeiData
+from build.gen.lei.v1.leirelationshipdata_pb2 import LeiRelationshipData
+from rb_crawler.constant import BOOTSTRAP_SERVER
+
+logging.basicConfig(
+    level=os.environ.get("LOGLEVEL", "INFO"), format="%(asctime)s | %(name)s | %(levelname)s | %(message)s"
+)
+log = logging.getLogger(__name__)
+
+TOPICS = {"corporate-events": Corporate, "lei-data": LeiData, "lei-relationship-data": LeiRelationshipData}
+
+SQL_TYPES = {
+    FieldDescriptor.TYPE_BOOL: "INTEGER",
+    FieldDescriptor.TYPE_BYTES: "BLOB",
+    FieldDescriptor.TYPE_DOUBLE: "REAL",
+    FieldDescriptor.TYPE_ENUM: "TEXT",
+    FieldDescriptor.TYPE_FLOAT: "REAL",
+    FieldDescriptor.TYPE_INT32: "INTEGER",
+    FieldDescriptor.TYPE_INT64: "INTEGER",
+    FieldDescriptor.TYPE_STRING: "TEXT",
+    FieldDescriptor.TYPE_UINT32: "INTEGER",
+    FieldDescriptor.TYPE_UINT64: "INTEGER",
+}
+
+# The sink is the only writer while backfilling. With WAL and synchronous = NORMAL a commit only appends to the log
+# without waiting for the disk, which may lose the last transactions on a power failure but never corrupts the
+# database. As offsets are only committed after the transaction, those records are consumed again.
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -262144",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA wal_autocheckpoint = 10000",
+]
+
+
+class TopicTable:
+    """
+    The table of a topic in the layout created by the JDBC sink connector (see connect/sqlite-sink.json): the record key
+    as primary key `id` and a column per protobuf field, with enums stored by their name.
+    """
+
+    def __init__(self, topic: str, message_type):
+        self.topic = topic
+        # Like the JDBC sink, value fields named like the key column are not stored (Corporate.id equals its key)
+        self.fields = [field for field in message_type.DESCRIPTOR.fields if field.name != "id"]
+        self.enum_names = {
+            field.name: {value.number: value.name for value in field.enum_type.values}
+            for field in self.fields
+            if field.type == FieldDescriptor.TYPE_ENUM
+        }
+        self.deserializer = ProtobufDeserializer(message_type, {"use.deprecated.format": True})
+        self.context = SerializationContext(topic, MessageField.VALUE)
+
+        self.columns = {field.name: f'"{field.name}" {SQL_TYPES[field.type]}' for field in self.fields}
+        self.create = (
+            f'CREATE TABLE IF NOT EXISTS "{topic}" ("id" TEXT NOT NULL PRIMARY KEY, {", ".join(self.columns.values())})'
+        )
+        names = ", ".join(f'"{field.name}"' for field in self.fields)
+        updates = ", ".join(f'"{field.name}" = excluded."{field.name}"' for field in self.fields)
+        self.upsert = (
+            f'INSERT INTO "{topic}" ("id", {names}) VALUES ({", ".join("?" * (len(self.fields) + 1))}) '
+            f'ON CONFLICT ("id") DO UPDATE SET {updates}'
+        )
+
+    def row(self, message: Message) -> tuple:
+        value = self.deserializer(message.value(), self.context)
+        row = [message.key().decode()]
+        for field in self.fields:
+            column = getattr(value, field.name)
+            if field.name in self.enum_names:
+                column = self.enum_names[field.name].get(column, column)
+            row.append(column)
+        return tuple(row)
+
+    def create_or_evolve(self, db_conn: sqlite3.Connection):
+        """Creates the table, or adds the columns of fields added to the schema since (like auto.evolve of JDBC)."""
+        db_conn.execute(self.create)
+        existing = {column for _, column, *_ in db_conn.execute(f'PRAGMA table_info("{self.topic}")')}
+        for name, column in self.columns.items():
+            if name not in existing:
+                db_conn.execute(f'ALTER TABLE "{self.topic}" ADD COLUMN {column}')
+
+
+class SqliteSink:
+    """
+    Writes the records of a consumer to SQLite in batches. Each batch is upserted in one transaction and the offsets
+    are committed to Kafka only after that, so a crash replays at most the uncommitted batch, which is idempotent.
+    """
+
+    def __init__(self, database: str, consumer: Consumer, batch_size: int = 10000):
+        self.db_conn = sqlite3.connect(database, isolation_level=None)
+        for pragma in PRAGMAS:
+            self.db_conn.execute(pragma)
+        self.tables = {topic: TopicTable(topic, message_type) for topic, message_type in TOPICS.items()}
+        for table in self.tables.values():
+            table.create_or_evolve(self.db_conn)
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.records = Counter()
+        self.skipped = 0
+        self.write_seconds = 0.0
+
+    def write(self, messages: Iterable[Message]):
+        rows = defaultdict(list)
+        for message in messages:
+            if message.error() is not None:
+                raise KafkaException(message.error())
+            if message.key() is None or message.value() is None:
+                # The JDBC sink neither accepts records without key nor deletes on tombstones
+                self.skipped += 1
+                continue
+            rows[message.topic()].append(self.tables[message.topic()].row(message))
+
+        start = time.perf_counter()
+        self.db_conn.execute("BEGIN")
+        try:
+            for topic, topic_rows in rows.items():
+                self.db_conn.executemany(self.tables[topic].upsert, topic_rows)
+        except BaseException:
+            self.db_conn.execute("ROLLBACK")
+            raise
+        self.db_conn.execute("COMMIT")
+        self.write_seconds += time.perf_counter() - start
+        for topic, topic_rows in rows.items():
+            self.records[topic] += len(topic_rows)
+
+    def run(self, idle_timeout: Optional[float] = None, max_records: Optional[int] = None, report_interval: float = 10.0):
+        """Consumes until no record arrived for idle_timeout seconds or max_records were written, if given."""
+        start = last_report = last_record = time.perf_counter()
+        try:
+            while max_records is None or sum(self.records.values()) < max_records:
+                messages = self.consumer.consume(num_messages=self.batch_size, timeout=1.0)
+                now = time.perf_counter()
+                if not messages:
+                    if idle_timeout is not None and now - last_record > idle_timeout:
+                        break
+                    continue
+                self.write(messages)
+                self.consumer.commit(asynchronous=False)
+                last_record = now
+                if now - last_report > report_interval:
+                    log.info(self.report(now - start))
+                    last_report = now
+        finally:
+            self.consumer.close()
+            self.db_conn.close()
+        click.echo(self.report(time.perf_counter() - start))
+
+    def report(self, seconds: float) -> str:
+        total = sum(self.records.values())
+        topics = ", ".join(f"{topic}: {count}" for topic, count in sorted(self.records.items()))
+        return (
+            f"{total} records in {seconds:.1f}s ({total / max(seconds, 1e-9):.0f} records/s, "
+            f"{self.write_seconds:.1f}s in SQLite, {self.skipped} skipped) - {topics}"
+        )
+
+
+@click.command()
+@click.option("-d", "--database", default="data/corporate.sqlite", help="The sqlite database file to write to")
+@click.option("-b", "--bootstrap-server", default=BOOTSTRAP_SERVER)
+@click.option("-g", "--group-id", default="sqlite-sink", help="Consumer group, whose offsets record the progress")
+@click.option("--batch-size", type=int, default=10000, help="Records per SQLite transaction")
+@click.option("--idle-timeout", type=float, default=None, help="Stop after this many seconds without records")
+@click.option("--max-records", type=int, default=None, help="Stop after this many records")
+def run(database: str, bootstrap_server: str, group_id: str, batch_size: int, idle_timeout: Optional[float],
+        max_records: Optional[int]):
+    consumer = Consumer({
+        "bootstrap.servers": bootstrap_server,
+        "group.id": group_id,
+        "auto.offset.reset": "earliest",
+        "enable.auto.commit": False,
+    })
+    consumer.subscribe(list(TOPICS))
+    SqliteSink(database, consumer, batch_size).run(idle_timeout, max_records)
+
+
+if __name__ == "__main__":
+    run()
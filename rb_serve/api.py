@@ -0,0 +1,196 @@
+import json
+import threading
+from typing import Dict, Iterator, NamedTuple, Optional, Tuple
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request, url_for
+
+from company_graph import EDGE_TYPES, CompanyGraph
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_HOPS = 4
+MAX_PATH_HOPS = 8
+MAX_GRAPH_COMPANIES = 2000
+
+
+class Resource(NamedTuple):
+    table: str
+    # Unique, increasing key the pages are sorted by and continue after (the keyset cursor)
+    key: str
+    columns: Tuple[str, ...]
+    # Columns (with their types) which can be filtered on by equal query arguments, e.g. /api/roles?company_id=1
+    filters: Dict[str, type]
+    where: Optional[str] = None
+    # Columns holding JSON documents, which are embedded as such instead of as strings
+    json_columns: Tuple[str, ...] = ()
+
+
+RESOURCES = {
+    "companies": Resource(
+        "companies",
+        "id",
+        ("id", "state", "reference_id", "registration_authority", "is_active", "name", "type", "address", "purpose",
+         "capital", "currency"),
+        {"is_active": int, "type": str},
+    ),
+    "persons": Resource(
+        "persons", "id", ("id", "first_name", "last_name", "birth_date", "birth_location"), {}, where="deleted = 0"
+    ),
+    "roles": Resource(
+        "corporate_roles",
+        "rowid",
+        ("rowid AS id", "company_id", "person_id", "role", "active", "start_date", "end_date"),
+        {"company_id": int, "person_id": int, "active": int},
+    ),
+    "typed-events": Resource(
+        "typed_events",
+        "rowid",
+        ("rowid AS id", "company_id", "event_date", "type", "data"),
+        {"company_id": int, "type": str},
+        json_columns=("data",),
+    ),
+    "parents": Resource("parents", "rowid", ("rowid AS id", "parent", "child"), {"parent": int, "child": int}),
+}
+
+api = Blueprint("api", __name__, url_prefix="/api")
+company_graph_lock = threading.Lock()
+
+
+def resource_or_404(name: str) -> Resource:
+    if (resource := RESOURCES.get(name)) is None:
+        abort(404)
+    return resource
+
+
+def select(resource: Resource, after: Optional[int] = None, limit: Optional[int] = None) -> Tuple[str, list]:
+    """
+    Builds the query of a resource from the filters of the request. Only the constant table and column names of the
+    resource end up in the SQL, so every combination of filters is a separate prepared statement.
+    """
+    conditions = [resource.where] if resource.where is not None else []
+    parameters = []
+    for column, column_type in resource.filters.items():
+        if (value := request.args.get(column, type=column_type)) is not None:
+            conditions.append(f"{column} = ?")
+            parameters.append(value)
+    if after is not None:
+        conditions.append(f"{resource.key} > ?")
+        parameters.append(after)
+    query = f"SELECT {', '.join(resource.columns)} FROM {resource.table}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += f" ORDER BY {resource.key}"
+    if limit is not None:
+        query += " LIMIT ?"
+        parameters.append(limit)
+    return query, parameters
+
+
+def to_dict(resource: Resource, row) -> dict:
+    document = dict(row)
+    for column in resource.json_columns:
+        if document[column] is not None:
+            document[column] = json.loads(document[column])
+    return document
+
+
+@api.route("/<name>")
+def list_resource(name: str):
+    """One page of the resource, continuing after the key given as `after`, with the URL of the next page if any."""
+    resource = resource_or_404(name)
+    after = request.args.get("after", type=int)
+    limit = min(max(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    query, parameters = select(resource, after, limit + 1)
+    with current_app.db_pool.connection() as db_conn:
+        rows = db_conn.execute(query, parameters).fetchall()
+
+    next_page = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        # Only the filters are carried over, other arguments could collide with the parameters of url_for
+        filters = {column: request.args[column] for column in resource.filters if column in request.args}
+        next_page = url_for("api.list_resource", name=name, **filters, after=rows[-1]["id"], limit=limit)
+    return jsonify(data=[to_dict(resource, row) for row in rows], next=next_page)
+
+
+@api.route("/<name>/<int:id>")
+def show_resource(name: str, id: int):
+    resource = resource_or_404(name)
+    with current_app.db_pool.connection() as db_conn:
+        row = db_conn.execute(
+            f"SELECT {', '.join(resource.columns)} FROM {resource.table} WHERE {resource.key} = ?", (id,)
+        ).fetchone()
+    if row is None:
+        abort(404)
+    return jsonify(to_dict(resource, row))
+
+
+@api.route("/export/<name>.ndjson")
+def export_resource(name: str):
+    """
+    The whole resource (or the rows matching the filters) as newline delimited JSON. Rows are written as they are read
+    from the cursor, so the export needs constant memory regardless of its size.
+    """
+    resource = resource_or_404(name)
+    query, parameters = select(resource)
+    # The generator runs after the request context is gone, so the pool is looked up beforehand
+    pool = current_app.db_pool
+
+    def rows() -> Iterator[str]:
+        with pool.connection() as db_conn:
+            for row in db_conn.execute(query, parameters):
+                yield json.dumps(to_dict(resource, row), ensure_ascii=False) + "\n"
+
+    return Response(rows(), mimetype="application/x-ndjson")
+
+
+def company_graph() -> CompanyGraph:
+    """The graph is loaded on its first use and dropped when a new database is swapped in."""
+    with company_graph_lock:
+        if current_app.company_graph is None:
+            with current_app.db_pool.connection() as db_conn:
+                current_app.company_graph = CompanyGraph.load(db_conn)
+        return current_app.company_graph
+
+
+def edge_kinds() -> tuple:
+    """The edge kinds given as `types`, e.g. `types=ownership,persons` (the default)."""
+    kinds = ()
+    for edge_type in request.args.get("types", ",".join(EDGE_TYPES)).split(","):
+        if edge_type not in EDGE_TYPES:
+            abort(400, f"Unknown edge type {edge_type}")
+        kinds += EDGE_TYPES[edge_type]
+    return kinds
+
+
+def company_nodes(depths: dict) -> list:
+    with current_app.db_pool.connection() as db_conn:
+        names = dict(db_conn.execute(
+            "SELECT id, name FROM companies WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(list(depths)),)
+        ))
+    return [{"id": company, "name": names.get(company), "depth": depth} for company, depth in depths.items()]
+
+
+@api.route("/graph/neighbourhood/<int:id>")
+def graph_neighbourhood(id: int):
+    """The companies up to `hops` ownership or shared person edges away and the edges between them."""
+    graph = company_graph()
+    if id not in graph:
+        abort(404)
+    hops = min(max(request.args.get("hops", 2, type=int), 0), MAX_HOPS)
+    limit = min(max(request.args.get("limit", 500, type=int), 1), MAX_GRAPH_COMPANIES)
+    depths, edges, truncated = graph.neighbourhood(id, hops, edge_kinds(), limit)
+    return jsonify(nodes=company_nodes(depths), edges=edges, truncated=truncated)
+
+
+@api.route("/graph/path/<int:source>/<int:target>")
+def graph_path(source: int, target: int):
+    """A shortest path between two companies of at most `max_hops` edges, 404 if there is none."""
+    graph = company_graph()
+    if source not in graph or target not in graph:
+        abort(404)
+    max_hops = min(max(request.args.get("max_hops", 6, type=int), 1), MAX_PATH_HOPS)
+    if (path := graph.shortest_path(source, target, max_hops, edge_kinds())) is None:
+        abort(404)
+    companies, edges = path
+    return jsonify(nodes=company_nodes({company: depth for depth, company in enumerate(companies)}), edges=edges)
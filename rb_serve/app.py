@@ -1,22 +1,72 @@
+import os
+import threading
+from functools import lru_cache
+from typing import Optional, Set
+
 from flask import Flask, render_template, redirect, request
-import sqlite3
-from dataclasses import dataclass
-from Levenshtein import distance
+
+from api import api
+from database import ConnectionPool, table_names
+from search_index import MappedSearchIndex, SearchIndex
 
 
-@dataclass
-class Company:
-    id: int
-    name: str
-    similarity: float = 0
+FULLTEXT_PAGE_SIZE = 20
+COMPANY_PAGE_CACHE_SIZE = 4096
 
 
 app = Flask(__name__)
-db_conn = sqlite3.connect("../data/corporate-task3.sqlite")
-app.companies = [
-    Company(*row) for row in db_conn.execute("SELECT id, name FROM companies WHERE name IS NOT NULL")
-]
-db_conn.close()
+# Both can be overridden by the environment variables RB_SERVE_DATABASE and RB_SERVE_SEARCH_INDEX
+app.config.from_mapping(DATABASE="../data/corporate-task3.sqlite", SEARCH_INDEX=None)
+app.config.from_prefixed_env("RB_SERVE")
+app.db_pool = ConnectionPool(app.config["DATABASE"])
+app.search_index = None
+app.company_graph = None
+app.tables = None
+app.register_blueprint(api)
+search_index_lock = threading.Lock()
+
+
+def search_index_path() -> str:
+    return app.config["SEARCH_INDEX"] or os.path.splitext(app.config["DATABASE"])[0] + ".names"
+
+
+def build_search_index() -> SearchIndex:
+    with app.db_pool.connection() as db_conn:
+        return SearchIndex(db_conn.execute("SELECT id, name FROM companies WHERE name IS NOT NULL"))
+
+
+def search_index() -> SearchIndex:
+    """The index prebuilt by `flask build-search-index` if there is one, else an index built from the database."""
+    with search_index_lock:
+        if app.search_index is None:
+            if os.path.exists(path := search_index_path()):
+                app.search_index = MappedSearchIndex(path)
+            else:
+                app.search_index = build_search_index()
+        return app.search_index
+
+
+def database_tables() -> Set[str]:
+    """The tables of the current database, looked up once per database build."""
+    if app.tables is None:
+        with app.db_pool.connection() as db_conn:
+            app.tables = table_names(db_conn)
+    return app.tables
+
+
+@app.cli.command("build-search-index")
+def build_search_index_command():
+    """Write the company name index of the database to a file the server maps at startup."""
+    build_search_index().save(search_index_path())
+
+
+@app.before_request
+def reload_swapped_database():
+    if app.db_pool.swapped():
+        company_page.cache_clear()
+        app.search_index = None
+        app.company_graph = None
+        app.tables = None
 
 
 @app.route("/")
@@ -26,63 +76,129 @@ def hello_world():
 
 @app.route("/search")
 def search():
+    return search_page(request.args.get("companyName"), request.args.get("mode") == "prefix")
+
+
+def search_page(name: Optional[str], prefix_mode: bool) -> str:
     results = []
-    if (name := request.args.get("companyName")) is not None:
-        for company in app.companies:
-            company.similarity = distance(company.name, name)
-        results = sorted(app.companies, key=lambda x: x.similarity)[:10]
+    if name is not None:
+        if prefix_mode:
+            results = search_index().prefix_search(name)
+        else:
+            results = search_index().search(name)
 
-    return render_template("search.html", results=results, searchedCompanyName=name or "SAP SE")
+    return render_template(
+        "search.html", results=results, searchedCompanyName=name or "SAP SE", prefixMode=prefix_mode
+    )
+
+
+def fulltext_query(text: str) -> str:
+    # Every word is quoted, so user input cannot contain FTS5 syntax, and matched as a prefix
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in text.split())
+
+
+@app.route("/fulltext")
+def fulltext_search():
+    text = request.args.get("q", "")
+    page = max(request.args.get("page", 1, type=int), 1)
+    companies, persons, more_results = [], [], False
+    if (query := fulltext_query(text)) != "":
+        offset = (page - 1) * FULLTEXT_PAGE_SIZE
+        # One more row than shown is fetched to know whether there is a next page
+        with app.db_pool.connection() as db_conn:
+            companies = db_conn.execute(
+                "SELECT c.id, c.name, c.address, snippet(companies_fts, 1, '', '', '…', 16) AS purpose "
+                "FROM companies_fts JOIN companies c on c.id = companies_fts.rowid "
+                "WHERE companies_fts MATCH ? "
+                "ORDER BY bm25(companies_fts, 10.0, 1.0, 2.0) "
+                "LIMIT ? OFFSET ?",
+                (query, FULLTEXT_PAGE_SIZE + 1, offset)
+            ).fetchall()
+            persons = db_conn.execute(
+                "SELECT p.id, p.last_name, p.first_name, p.birth_date, p.birth_location, "
+                "   GROUP_CONCAT(c.id || ':' || c.name, char(31)) AS companies "
+                "FROM persons_fts "
+                "JOIN persons p on p.id = persons_fts.rowid "
+                "JOIN corporate_roles cr on cr.person_id = p.id "
+                "JOIN companies c on c.id = cr.company_id "
+                "WHERE persons_fts MATCH ? "
+                "AND cr.active = 1 "
+                "GROUP BY p.id "
+                "ORDER BY min(persons_fts.rank) "
+                "LIMIT ? OFFSET ?",
+                (query, FULLTEXT_PAGE_SIZE + 1, offset)
+            ).fetchall()
+        more_results = len(companies) > FULLTEXT_PAGE_SIZE or len(persons) > FULLTEXT_PAGE_SIZE
+        companies = companies[:FULLTEXT_PAGE_SIZE]
+        # GROUP_CONCAT skips companies without name and is NULL if no company of the person has one
+        persons = [
+            dict(person, companies=[
+                company.split(":", 1) for company in (person["companies"] or "").split("\x1f") if company
+            ])
+            for person in persons[:FULLTEXT_PAGE_SIZE]
+        ]
+
+    return render_template(
+        "fulltext.html", companies=companies, persons=persons, query=text, page=page, more_results=more_results
+    )
 
 
-@app.route("/companies/<id>")
+@app.route("/companies/<int:id>")
 def show_company(id: int):
-    db_conn = sqlite3.connect("../data/corporate-task3.sqlite")
-    db_conn.row_factory = sqlite3.Row
-    company = db_conn.execute("SELECT * FROM companies WHERE id = ?", (id,)).fetchone()
-
-    persons = db_conn.execute(
-        "SELECT p.last_name, p.first_name, cr.role, cr.start_date "
-        "FROM corporate_roles cr JOIN persons p on cr.person_id = p.id "
-        "WHERE cr.active = 1 "
-        "AND cr.company_id = ?"
-        "ORDER BY p.last_name, p.first_name",
-        (id,)
-    ).fetchall()
-
-    parents = list(db_conn.execute(
-        "SELECT id, name "
-        "FROM companies JOIN parents p on companies.id = p.parent "
-        "WHERE p.child = ? "
-        "ORDER BY name",
-        (id,)
-    ).fetchall())
-
-    children = list(db_conn.execute(
-        "SELECT id, name "
-        "FROM companies JOIN parents p on companies.id = p.child "
-        "WHERE p.parent = ? "
-        "ORDER BY name",
-        (id,)
-    ).fetchall())
-
-    related_companies = db_conn.execute(
-        "SELECT c.id, c.name, GROUP_CONCAT(p.last_name || ', ' || p.first_name || ' (' || r.role || ')', ', ') as persons_in_common "
-        "FROM companies c JOIN corporate_roles r on c.id = r.company_id JOIN persons p on r.person_id = p.id "
-        "WHERE p.id IN ("
-        "   SELECT persons.id "
-        "   FROM persons JOIN corporate_roles cr on persons.id = cr.person_id "
-        "   WHERE cr.active = 1 "
-        "   AND cr.company_id = ?"
-        ") "
-        "AND r.active = 1 "
-        "AND c.id != ? "
-        "GROUP BY c.id, c.name "
-        "ORDER BY c.name",
-        (id, id)
-    ).fetchall()
-
-    db_conn.close()
+    return company_page(id)
+
+
+@lru_cache(maxsize=COMPANY_PAGE_CACHE_SIZE)
+def company_page(id: int) -> str:
+    # Cleared by reload_swapped_database, the database is read-only otherwise
+    with app.db_pool.connection() as db_conn:
+        company = db_conn.execute("SELECT * FROM companies WHERE id = ?", (id,)).fetchone()
+
+        persons = db_conn.execute(
+            "SELECT p.last_name, p.first_name, cr.role, cr.start_date "
+            "FROM corporate_roles cr JOIN persons p on cr.person_id = p.id "
+            "WHERE cr.active = 1 "
+            "AND cr.company_id = ?"
+            "ORDER BY p.last_name, p.first_name",
+            (id,)
+        ).fetchall()
+
+        parents = list(db_conn.execute(
+            "SELECT id, name "
+            "FROM companies JOIN parents p on companies.id = p.parent "
+            "WHERE p.child = ? "
+            "ORDER BY name",
+            (id,)
+        ).fetchall())
+
+        children = list(db_conn.execute(
+            "SELECT id, name "
+            "FROM companies JOIN parents p on companies.id = p.child "
+            "WHERE p.parent = ? "
+            "ORDER BY name",
+            (id,)
+        ).fetchall())
+
+        # Only built by the ownership stage, older databases lack it
+        ownership = None
+        if "ownership" in database_tables():
+            ownership = db_conn.execute(
+                "SELECT o.ultimate_parent AS id, c.name, o.depth, o.group_size "
+                "FROM ownership o JOIN companies c on c.id = o.ultimate_parent "
+                "WHERE o.company_id = ?",
+                (id,)
+            ).fetchone()
+
+        # Only built by the transformation and deduplication stages, older databases lack it
+        related_companies = []
+        if "related_companies" in database_tables():
+            related_companies = db_conn.execute(
+                "SELECT c.id, c.name, rc.persons_in_common "
+                "FROM related_companies rc JOIN companies c on c.id = rc.related_id "
+                "WHERE rc.company_id = ? "
+                "ORDER BY c.name",
+                (id,)
+            ).fetchall()
 
     return render_template(
         "company.html",
@@ -90,5 +206,6 @@ def show_company(id: int):
         persons=persons,
         parents=parents,
         children=children,
+        ownership=ownership,
         related_companies=related_companies
     )
@@ -0,0 +1,79 @@
+"""
+ASGI serving mode of the search and company pages, e.g. `uvicorn asgi:app` in this directory.
+
+The event loop only parses requests and writes responses. Searches and company pages are produced by the same
+functions as in the Flask app, on a bounded pool of threads, each of which holds at most one pooled database
+connection at a time.
+"""
+import asyncio
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from app import app as flask_app, company_page, reload_swapped_database, search_page
+
+THREADS = int(os.environ.get("RB_SERVE_THREADS", flask_app.db_pool.size))
+# Requests waiting for a thread beyond this are answered with 503 instead of piling up
+MAX_QUEUED = int(os.environ.get("RB_SERVE_MAX_QUEUED", 64 * THREADS))
+
+COMPANY_PATH = re.compile(r"/companies/(\d+)")
+
+executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix="rb_serve")
+# Only changed on the event loop, so it needs no lock
+in_flight = 0
+
+
+def render(page, *args) -> str:
+    with flask_app.app_context():
+        reload_swapped_database()
+        return page(*args)
+
+
+async def send_response(send, status: int, body: bytes = b"", headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-length", str(len(body)).encode()), *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    global in_flight
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    path = scope["path"]
+    if scope["method"] != "GET":
+        return await send_response(send, 405)
+    if path == "/":
+        return await send_response(send, 302, headers=[(b"location", b"/search")])
+    if path == "/search":
+        arguments = parse_qs(scope["query_string"].decode(), keep_blank_values=True)
+        name = arguments["companyName"][-1] if "companyName" in arguments else None
+        page = (search_page, name, arguments.get("mode", [None])[-1] == "prefix")
+    elif company := COMPANY_PATH.fullmatch(path):
+        page = (company_page, int(company.group(1)))
+    else:
+        return await send_response(send, 404)
+
+    if in_flight >= THREADS + MAX_QUEUED:
+        return await send_response(send, 503, headers=[(b"retry-after", b"1")])
+    in_flight += 1
+    try:
+        body = await asyncio.get_running_loop().run_in_executor(executor, render, *page)
+    finally:
+        in_flight -= 1
+    await send_response(send, 200, body.encode(), headers=[(b"content-type", b"text/html; charset=utf-8")])
@@ -0,0 +1,171 @@
+import sqlite3
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from database import table_names
+
+# Kinds of adjacency entries, seen from the company the entry belongs to
+PARENT = 0  # the neighbour owns the company
+CHILD = 1  # the company owns the neighbour
+SHARED_PERSONS = 2  # both have active persons in common
+
+EDGE_TYPES = {"ownership": (PARENT, CHILD), "persons": (SHARED_PERSONS,)}
+
+
+class CompanyGraph:
+    """
+    Undirected company graph of the ownership (`parents`) and shared person (`related_companies`) edges in compressed
+    sparse row form: the neighbours of company i are targets[offsets[i]:offsets[i + 1]], with the kind of every edge in
+    kinds and the number of persons in common in weights. Company ids index the offsets directly, as they are dense.
+
+    Queries only allocate for the companies they visit, so they do not depend on the size of the graph. Databases built
+    without `related_companies` have no shared person edges.
+    """
+
+    def __init__(self, num_companies: int, edges: Iterator[Tuple[int, int, int, int]]):
+        sources, targets, kinds, weights = array("I"), array("I"), array("B"), array("I")
+        for source, target, kind, weight in edges:
+            sources.append(source)
+            targets.append(target)
+            kinds.append(kind)
+            weights.append(weight)
+
+        self.offsets = array("Q", [0]) * (num_companies + 2)
+        for source in sources:
+            self.offsets[source + 1] += 1
+        for i in range(num_companies + 1):
+            self.offsets[i + 1] += self.offsets[i]
+        position = self.offsets[:-1]
+        self.targets = array("I", [0]) * len(sources)
+        self.kinds = array("B", [0]) * len(sources)
+        self.weights = array("I", [0]) * len(sources)
+        for edge, source in enumerate(sources):
+            slot = position[source]
+            self.targets[slot] = targets[edge]
+            self.kinds[slot] = kinds[edge]
+            self.weights[slot] = weights[edge]
+            position[source] += 1
+
+    @classmethod
+    def load(cls, db_conn: sqlite3.Connection) -> "CompanyGraph":
+        num_companies = db_conn.execute("SELECT coalesce(max(id), 0) FROM companies").fetchone()[0]
+        tables = table_names(db_conn)
+
+        def edges():
+            for parent, child in db_conn.execute("SELECT parent, child FROM parents WHERE parent != child"):
+                yield child, parent, PARENT, 0
+                yield parent, child, CHILD, 0
+            # related_companies already holds both directions of every pair
+            if "related_companies" in tables:
+                yield from db_conn.execute(
+                    f"SELECT company_id, related_id, {SHARED_PERSONS}, shared_persons FROM related_companies"
+                )
+
+        return cls(num_companies, edges())
+
+    def __len__(self):
+        return len(self.offsets) - 2
+
+    def __contains__(self, company_id: int):
+        return 0 <= company_id < len(self.offsets) - 1
+
+    def neighbours(self, company_id: int, kinds: Tuple[int, ...]) -> Iterator[int]:
+        """The adjacency slots of a company, the neighbour of slot s is targets[s]."""
+        for slot in range(self.offsets[company_id], self.offsets[company_id + 1]):
+            if self.kinds[slot] in kinds:
+                yield slot
+
+    def edge(self, company_id: int, slot: int) -> dict:
+        neighbour, kind = self.targets[slot], self.kinds[slot]
+        if kind == PARENT:
+            return {"source": neighbour, "target": company_id, "type": "owns"}
+        if kind == CHILD:
+            return {"source": company_id, "target": neighbour, "type": "owns"}
+        return {
+            "source": min(company_id, neighbour),
+            "target": max(company_id, neighbour),
+            "type": "shared_persons",
+            "shared_persons": self.weights[slot],
+        }
+
+    def neighbourhood(self, company_id: int, hops: int, kinds: Tuple[int, ...], max_companies: int) \
+            -> Tuple[Dict[int, int], List[dict], bool]:
+        """
+        Breadth-first search up to hops edges away. Returns the depth of every reached company, the edges between them
+        and whether the search stopped at max_companies.
+        """
+        depths = {company_id: 0}
+        edges = {}
+        truncated = False
+        frontier = [company_id]
+        for depth in range(1, hops + 1):
+            next_frontier = []
+            for company in frontier:
+                for slot in self.neighbours(company, kinds):
+                    neighbour = self.targets[slot]
+                    if neighbour not in depths:
+                        if len(depths) >= max_companies:
+                            truncated = True
+                            continue
+                        depths[neighbour] = depth
+                        next_frontier.append(neighbour)
+                    edge = self.edge(company, slot)
+                    edges[edge["source"], edge["target"], edge["type"]] = edge
+            frontier = next_frontier
+        return depths, list(edges.values()), truncated
+
+    def shortest_path(self, source: int, target: int, max_hops: int, kinds: Tuple[int, ...]) \
+            -> Optional[Tuple[List[int], List[dict]]]:
+        """
+        Bidirectional breadth-first search, always expanding the smaller frontier by a whole level. Returns the
+        companies and edges of a shortest path, or None if there is none within max_hops.
+        """
+        if source == target:
+            return [source], []
+        # The company and adjacency slot every reached company was reached from, per direction
+        reached = ({source: None}, {target: None})
+        frontiers = ([source], [target])
+        for _ in range(max_hops):
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            own, other = reached[side], reached[1 - side]
+            next_frontier = []
+            best = None
+            for company in frontiers[side]:
+                for slot in self.neighbours(company, kinds):
+                    neighbour = self.targets[slot]
+                    if neighbour in own:
+                        continue
+                    own[neighbour] = (company, slot)
+                    next_frontier.append(neighbour)
+                    if neighbour in other:
+                        length = self.path_length(own, neighbour) + self.path_length(other, neighbour)
+                        if best is None or length < best[0]:
+                            best = (length, neighbour)
+            if best is not None:
+                return self.path(reached, best[1])
+            if not next_frontier:
+                return None
+            frontiers = (next_frontier, frontiers[1]) if side == 0 else (frontiers[0], next_frontier)
+        return None
+
+    @staticmethod
+    def path_length(reached: dict, company: int) -> int:
+        length = 0
+        while reached[company] is not None:
+            company = reached[company][0]
+            length += 1
+        return length
+
+    def path(self, reached: Tuple[dict, dict], meeting: int) -> Tuple[List[int], List[dict]]:
+        companies, edges = [meeting], []
+        company = meeting
+        while reached[0][company] is not None:
+            company, slot = reached[0][company]
+            companies.insert(0, company)
+            edges.insert(0, self.edge(company, slot))
+        company = meeting
+        while reached[1][company] is not None:
+            company, slot = reached[1][company]
+            companies.append(company)
+            edges.append(self.edge(company, slot))
+        return companies, edges
@@ -0,0 +1,86 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Set, Tuple
+
+
+def file_version(path: Path) -> Tuple[int, int, int]:
+    """Identifies a database build: a new build swapped in by renaming it over the old one changes the inode."""
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def table_names(db_conn: sqlite3.Connection) -> Set[str]:
+    """Tables of later pipeline stages are missing in databases built without them, which pages have to check for."""
+    return {name for name, in db_conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+class ConnectionPool:
+    """
+    Pool of read-only connections to a database which is only replaced as a whole, never modified in place.
+
+    The connections are opened in immutable mode, so SQLite skips locking and change detection, and with memory-mapped
+    I/O. Every connection keeps its prepared statements in its statement cache, which is why the queries should be
+    constant strings with parameters. As immutable connections would not notice a new build, swapped() compares the
+    database file with the one the pool was opened on and retires all connections of the previous build.
+    """
+
+    def __init__(self, path: str, size: int = 8, mmap_size: int = 1 << 30, cached_statements: int = 64):
+        self.path = Path(os.path.abspath(path))
+        self.size = size
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.version = file_version(self.path)
+        self.generation = 0
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            f"{self.path.as_uri()}?mode=ro&immutable=1",
+            uri=True,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        connection.row_factory = sqlite3.Row
+        connection.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+        return connection
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        generation, connection = None, None
+        while connection is None:
+            try:
+                generation, connection = self.idle.get_nowait()
+            except queue.Empty:
+                generation, connection = self.generation, self.connect()
+            if generation != self.generation:
+                connection.close()
+                connection = None
+        try:
+            yield connection
+        finally:
+            if generation == self.generation and self.idle.qsize() < self.size:
+                self.idle.put((generation, connection))
+            else:
+                connection.close()
+
+    def swapped(self) -> bool:
+        """Returns whether a new database build was swapped in since the last call, a single stat() otherwise."""
+        version = file_version(self.path)
+        if version == self.version:
+            return False
+        with self.lock:
+            if version == self.version:
+                return False
+            self.version = version
+            self.generation += 1
+        while True:
+            try:
+                _, connection = self.idle.get_nowait()
+            except queue.Empty:
+                return True
+            connection.close()
@@ -0,0 +1,310 @@
+"""
+Load test of rb_serve: replays a mix of searches and company pages and reports throughput and latency percentiles.
+
+    python load_test.py --server asgi --concurrency 32 --duration 30
+
+Without --database, it runs on a small generated fixture database (--generate-fixture), so that it does not need a
+build of the full data. Pass --database ../data/corporate-task3.sqlite to test on one.
+
+Company pages are requested with a Zipf distributed popularity, so that (like real traffic) a few companies are
+requested very often and the page cache is exercised. Searches use company names with typos, prefix searches their
+first characters.
+"""
+import http.client
+import itertools
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, urlsplit
+
+import click
+
+SERVE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SERVER_COMMANDS = {
+    "wsgi": lambda port: [sys.executable, "-m", "flask", "run", "--with-threads", "--port", str(port)],
+    "asgi": lambda port: [sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(port), "--log-level", "warning"],
+}
+PERCENTILES = (50, 90, 99)
+# Generated when no --database is given, data/ is not under version control
+FIXTURE = os.path.join(SERVE_DIRECTORY, os.pardir, "data", "fixture.sqlite")
+
+FIXTURE_SCHEMA = """
+CREATE TABLE companies (
+    id INTEGER PRIMARY KEY, name TEXT, address TEXT, type TEXT, purpose TEXT, is_active INTEGER,
+    registration_authority TEXT, reference_id TEXT, capital REAL, currency TEXT, state TEXT
+);
+CREATE TABLE persons (
+    id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, birth_date TEXT, birth_location TEXT,
+    deleted INTEGER DEFAULT 0
+);
+CREATE TABLE corporate_roles (
+    company_id INTEGER, person_id INTEGER, role TEXT, active INTEGER DEFAULT 1, start_date TEXT, end_date TEXT
+);
+CREATE INDEX corporate_roles_company_id ON corporate_roles(company_id, active, person_id);
+CREATE INDEX corporate_roles_person_id ON corporate_roles(person_id, active, company_id);
+CREATE TABLE parents (parent INTEGER, child INTEGER);
+CREATE INDEX parents_parent ON parents(parent);
+CREATE INDEX parents_child ON parents(child);
+"""
+FIXTURE_WORDS = {
+    "names": ["Müller", "Schmidt", "Schneider", "Fischer", "Weber", "Meyer", "Wagner", "Becker", "Hoffmann", "Koch"],
+    "first_names": ["Anna", "Hans", "Maria", "Peter", "Ursula", "Klaus", "Petra", "Jürgen", "Sabine", "Thomas"],
+    "industries": ["Bau", "Immobilien", "Software", "Handel", "Logistik", "Energie", "Consulting", "Verwaltung"],
+    "types": ["GmbH", "GmbH & Co. KG", "AG", "UG (haftungsbeschränkt)", "e.K."],
+    "cities": ["Berlin", "Hamburg", "München", "Köln", "Frankfurt am Main", "Potsdam"],
+    "roles": ["Geschäftsführer", "Vorstand", "Prokurist", "Liquidator"],
+}
+
+
+class RequestMix:
+    def __init__(self, companies: List[Tuple[int, str]], weights: Dict[str, float], zipf_exponent: float = 1.1,
+                 seed: int = 42):
+        self.random = random.Random(seed)
+        self.companies = companies
+        self.random.shuffle(self.companies)
+        self.popularity = list(itertools.accumulate(1 / rank ** zipf_exponent for rank in range(1, len(companies) + 1)))
+        self.kinds = list(weights)
+        self.kind_weights = list(itertools.accumulate(weights.values()))
+        self.lock = threading.Lock()
+
+    def company(self) -> Tuple[int, str]:
+        return self.random.choices(self.companies, cum_weights=self.popularity)[0]
+
+    def typo(self, name: str) -> str:
+        position = self.random.randrange(len(name))
+        return name[:position] + name[position + 1:]
+
+    def next(self) -> Tuple[str, str]:
+        """Returns the kind and path of the next request, the random generator is shared by all clients."""
+        with self.lock:
+            kind = self.random.choices(self.kinds, cum_weights=self.kind_weights)[0]
+            company_id, name = self.company()
+            if kind == "company":
+                return kind, f"/companies/{company_id}"
+            if kind == "prefix":
+                return kind, f"/search?mode=prefix&companyName={quote(name[:self.random.randint(3, 8)])}"
+            return kind, f"/search?companyName={quote(self.typo(name))}"
+
+
+def client(url: str, mix: RequestMix, start: float, stop: float, results: Dict[str, List[float]],
+           errors: Dict[str, int]):
+    """Sends requests on one keep-alive connection until stop, recording those sent after start."""
+    address = urlsplit(url)
+    connection = http.client.HTTPConnection(address.hostname, address.port, timeout=30)
+    latencies = defaultdict(list)
+    failures = defaultdict(int)
+    while (sent := time.perf_counter()) < stop:
+        kind, path = mix.next()
+        try:
+            connection.request("GET", address.path.rstrip("/") + path)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            ok = False
+        if sent >= start:
+            latencies[kind].append(time.perf_counter() - sent)
+            if not ok:
+                failures[kind] += 1
+    connection.close()
+    for kind, values in latencies.items():
+        results[kind].extend(values)
+    for kind, count in failures.items():
+        errors[kind] += count
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    return sorted_values[min(int(p / 100 * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def summary(latencies: List[float], errors: int, duration: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": len(latencies) / duration,
+        **{f"p{p}_ms": percentile(latencies, p) * 1000 if latencies else None for p in PERCENTILES},
+        "max_ms": latencies[-1] * 1000 if latencies else None,
+    }
+
+
+def wait_until_serving(url: str, server: subprocess.Popen, timeout: float = 120):
+    address = urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise click.ClickException(f"The server exited with {server.returncode}")
+        try:
+            connection = http.client.HTTPConnection(address.hostname, address.port, timeout=5)
+            connection.request("GET", "/search")
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise click.ClickException(f"The server did not answer within {timeout} seconds")
+
+
+def start_server(kind: str, database: str, port: int) -> subprocess.Popen:
+    environment = {**os.environ, "RB_SERVE_DATABASE": os.path.abspath(database), "FLASK_APP": "app"}
+    # The access log of the server would be interleaved with the report
+    return subprocess.Popen(
+        SERVER_COMMANDS[kind](port), cwd=SERVE_DIRECTORY, env=environment, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("company", "search", "prefix"):
+            raise click.BadParameter(f"Unknown request kind {kind}")
+        weights[kind] = float(weight)
+    return weights
+
+
+def generate_fixture(path: str, num_companies: int, seed: int):
+    """
+    Writes a database with the tables the company pages and searches read, filled with synthetic companies, persons,
+    roles and ownership edges. The same arguments always generate the same database.
+    """
+    rng = random.Random(seed)
+    words = FIXTURE_WORDS
+    temporary_path = f"{path}.tmp"
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    db_conn = sqlite3.connect(temporary_path)
+    db_conn.executescript(FIXTURE_SCHEMA)
+    def companies():
+        for id in range(1, num_companies + 1):
+            company_type, city = rng.choice(words["types"]), rng.choice(words["cities"])
+            yield (
+                id,
+                f"{rng.choice(words['names'])} {rng.choice(words['industries'])} {id} {company_type}",
+                f"Hauptstraße {rng.randint(1, 200)}, {rng.randint(10000, 99999)} {city}",
+                company_type,
+                f"{rng.choice(words['industries'])} und {rng.choice(words['industries'])}",
+                int(rng.random() < 0.9),
+                f"Amtsgericht {city}",
+                f"HRB {rng.randint(1000, 999999)}",
+                rng.choice([25000.0, 50000.0, 100000.0]),
+                "EUR",
+                "be",
+            )
+
+    db_conn.executemany("INSERT INTO companies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", companies())
+    num_persons = num_companies * 3 // 2
+    db_conn.executemany(
+        "INSERT INTO persons (id, first_name, last_name, birth_date, birth_location) VALUES (?, ?, ?, ?, ?)",
+        (
+            (
+                id,
+                rng.choice(words["first_names"]),
+                rng.choice(words["names"]),
+                f"{rng.randint(1940, 2000)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                rng.choice(words["cities"]),
+            )
+            for id in range(1, num_persons + 1)
+        ),
+    )
+    db_conn.executemany(
+        "INSERT INTO corporate_roles (company_id, person_id, role, active, start_date) VALUES (?, ?, ?, ?, ?)",
+        (
+            (
+                company_id,
+                rng.randint(1, num_persons),
+                rng.choice(words["roles"]),
+                int(rng.random() < 0.8),
+                f"{rng.randint(1990, 2022)}-{rng.randint(1, 12):02d}-01",
+            )
+            for company_id in range(1, num_companies + 1)
+            for _ in range(rng.randint(1, 4))
+        ),
+    )
+    # Parents have smaller ids than their children, so the ownership graph has no cycles
+    db_conn.executemany(
+        "INSERT INTO parents VALUES (?, ?)",
+        ((rng.randint(1, child - 1), child) for child in range(2, num_companies + 1) if rng.random() < 0.1),
+    )
+    db_conn.commit()
+    db_conn.close()
+    # Replaced as a whole, like a new build, so that a server still reading the previous fixture notices it
+    os.replace(temporary_path, path)
+
+
+@click.command()
+@click.option("-d", "--database", default=None,
+              help="Database the requests are drawn from, by default a fixture generated at --generate-fixture")
+@click.option("--generate-fixture", "fixture", type=click.Path(dir_okay=False), default=FIXTURE,
+              help="Without --database, generate a fixture database at this path (default: data/fixture.sqlite)")
+@click.option("--fixture-companies", type=int, default=10000, help="Number of companies of the generated fixture")
+@click.option("--url", default="http://127.0.0.1:5000", help="Server to test")
+@click.option("--server", type=click.Choice(["wsgi", "asgi"]), default=None,
+              help="Start this server on the database and the port of --url, instead of testing a running one")
+@click.option("-c", "--concurrency", type=int, default=16, help="Number of concurrent clients")
+@click.option("--duration", type=float, default=30, help="Measured seconds")
+@click.option("--warmup", type=float, default=5, help="Seconds of requests before measuring")
+@click.option("--mix", default="company=0.6,search=0.3,prefix=0.1", help="Weights of the request kinds")
+@click.option("--seed", type=int, default=42)
+@click.option("--output", type=click.Path(), default=None, help="Also write the report to this JSON file")
+def run(database, fixture, fixture_companies, url, server, concurrency, duration, warmup, mix, seed, output):
+    if database is None:
+        generate_fixture(fixture, fixture_companies, seed)
+        database = fixture
+    db_conn = sqlite3.connect(database)
+    companies = db_conn.execute("SELECT id, name FROM companies WHERE name IS NOT NULL AND name != ''").fetchall()
+    db_conn.close()
+    request_mix = RequestMix(companies, parse_mix(mix), seed=seed)
+
+    server_process: Optional[subprocess.Popen] = None
+    if server is not None:
+        server_process = start_server(server, database, urlsplit(url).port)
+    try:
+        if server_process is not None:
+            wait_until_serving(url, server_process)
+        results = defaultdict(list)
+        errors = defaultdict(int)
+        start = time.perf_counter() + warmup
+        clients = [
+            threading.Thread(target=client, args=(url, request_mix, start, start + duration, results, errors))
+            for _ in range(concurrency)
+        ]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+    report = {
+        "server": server or url,
+        "concurrency": concurrency,
+        "duration": duration,
+        "total": summary(list(itertools.chain.from_iterable(results.values())), sum(errors.values()), duration),
+        **{kind: summary(results[kind], errors[kind], duration) for kind in sorted(results)},
+    }
+    click.echo(f"{'':10}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}")
+    for kind in ["total", *sorted(results)]:
+        row = report[kind]
+        click.echo(
+            f"{kind:10}{row['requests']:>10}{row['errors']:>8}{row['requests_per_second']:>10.1f}"
+            + "".join(f"{row[f'p{p}_ms'] or 0:>10.1f}" for p in PERCENTILES)
+        )
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,195 @@
+import heapq
+import mmap
+import os
+import re
+import struct
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from typing import Iterable, List, NamedTuple, Sequence, Tuple
+
+from Levenshtein import distance
+
+NON_ALPHANUMERIC = re.compile(r"[\W_]+")
+
+# File header: magic, number of documents, trigrams and postings, size of the UTF-8 names and max_postings
+INDEX_FILE_HEADER = struct.Struct("<8s5Q")
+INDEX_FILE_MAGIC = b"RBNAMES1"
+
+
+class SearchResult(NamedTuple):
+    id: int
+    name: str
+    similarity: float
+
+
+def normalize(name: str) -> str:
+    return NON_ALPHANUMERIC.sub(" ", name.lower()).strip()
+
+
+def trigrams(name: str) -> set:
+    padded = f"  {normalize(name)} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def trigram_key(trigram: str) -> int:
+    # Code points have at most 21 bits, so the three of a trigram fit into an integer with the same order
+    return ord(trigram[0]) << 42 | ord(trigram[1]) << 21 | ord(trigram[2])
+
+
+def write_section(file, section: array):
+    file.write(section.tobytes())
+    # Sections start at multiples of 8 bytes, so they can be cast to their item type when mapped
+    file.write(bytes(-file.tell() % 8))
+
+
+class SearchIndex:
+    """
+    Immutable company name index: a trigram inverted index for fuzzy queries and the documents sorted by their
+    normalized name for prefix queries. Searches never modify the index, so it can be shared by concurrent requests.
+    """
+
+    def __init__(self, companies: Iterable[Tuple[int, str]], max_posting_share: float = 0.05, candidates: int = 200):
+        self.candidates = candidates
+        self.ids = array("q")
+        self.names: List[str] = []
+        postings = {}
+        for company_id, name in companies:
+            doc = len(self.ids)
+            self.ids.append(company_id)
+            self.names.append(name)
+            for trigram in trigrams(name):
+                postings.setdefault(trigram, array("I")).append(doc)
+        self.postings = postings
+        # Trigrams like "gmb" occur in most names and are skipped when collecting candidates
+        self.max_postings = max(int(max_posting_share * len(self.ids)), 1)
+        self.sorted_docs = array("I", sorted(range(len(self.names)), key=lambda doc: normalize(self.names[doc])))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def posting(self, trigram: str):
+        return self.postings.get(trigram, ())
+
+    def result(self, doc: int, similarity: float) -> SearchResult:
+        return SearchResult(self.ids[doc], self.names[doc], similarity)
+
+    def search(self, query: str, limit: int = 10) -> List[SearchResult]:
+        """Fuzzy search: the names sharing most trigrams with the query, ranked by their edit distance to it."""
+        posting_lists = [posting for trigram in trigrams(query) if len(posting := self.posting(trigram)) != 0]
+        selective = [posting for posting in posting_lists if len(posting) <= self.max_postings]
+        if len(selective) == 0:
+            # Only common trigrams, use the shortest posting list of them
+            selective = sorted(posting_lists, key=len)[:1]
+
+        shared_trigrams = Counter()
+        for posting in selective:
+            shared_trigrams.update(posting)
+        candidates = heapq.nlargest(self.candidates, shared_trigrams.items(), key=lambda item: item[1])
+        ranked = heapq.nsmallest(
+            limit, ((distance(self.names[doc], query), doc) for doc, _ in candidates)
+        )
+        return [self.result(doc, similarity) for similarity, doc in ranked]
+
+    def save(self, path: str):
+        """
+        Writes the index to a file, which MappedSearchIndex can use without building it again. The file is written
+        next to path and then renamed, so a server never maps a partially written index.
+        """
+        trigram_list = sorted(self.postings, key=trigram_key)
+        posting_offsets = array("Q", [0])
+        for trigram in trigram_list:
+            posting_offsets.append(posting_offsets[-1] + len(self.postings[trigram]))
+        names = [name.encode() for name in self.names]
+        name_offsets = array("Q", [0])
+        for name in names:
+            name_offsets.append(name_offsets[-1] + len(name))
+
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(INDEX_FILE_HEADER.pack(
+                INDEX_FILE_MAGIC, len(self.ids), len(trigram_list), posting_offsets[-1], name_offsets[-1],
+                self.max_postings
+            ))
+            write_section(file, self.ids)
+            write_section(file, self.sorted_docs)
+            write_section(file, array("Q", map(trigram_key, trigram_list)))
+            write_section(file, posting_offsets)
+            for trigram in trigram_list:
+                file.write(self.postings[trigram].tobytes())
+            file.write(bytes(-file.tell() % 8))
+            write_section(file, name_offsets)
+            for name in names:
+                file.write(name)
+        os.replace(f"{path}.tmp", path)
+
+    def prefix_search(self, query: str, limit: int = 10) -> List[SearchResult]:
+        """Prefix search on the normalized names, in alphabetical order."""
+        prefix = normalize(query)
+        low, high = 0, len(self.sorted_docs)
+        while low < high:
+            middle = (low + high) // 2
+            if normalize(self.names[self.sorted_docs[middle]]) < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        results = []
+        for position in range(low, min(low + limit, len(self.sorted_docs))):
+            doc = self.sorted_docs[position]
+            if not normalize(self.names[doc]).startswith(prefix):
+                break
+            results.append(self.result(doc, 0))
+        return results
+
+
+class MappedNames(Sequence):
+    """The names of a mapped index, only decoded when accessed."""
+
+    def __init__(self, offsets: memoryview, data: memoryview):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, doc: int) -> str:
+        return str(self.data[self.offsets[doc]:self.offsets[doc + 1]], "utf-8")
+
+
+class MappedSearchIndex(SearchIndex):
+    """
+    A SearchIndex written by SearchIndex.save, memory-mapped instead of loaded. Opening it only reads the header; the
+    pages are read on demand and shared by all processes mapping the same file through the page cache.
+    """
+
+    def __init__(self, path: str, candidates: int = 200):
+        self.candidates = candidates
+        with open(path, "rb") as file:
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, num_docs, num_trigrams, num_postings, names_size, self.max_postings = \
+            INDEX_FILE_HEADER.unpack_from(self.mapping)
+        if magic != INDEX_FILE_MAGIC:
+            raise ValueError(f"{path} is not a search index file")
+
+        view = memoryview(self.mapping)
+        position = INDEX_FILE_HEADER.size
+
+        def section(item_format: str, length: int) -> memoryview:
+            nonlocal position
+            start = position
+            position += -(-struct.calcsize(item_format) * length // 8) * 8
+            return view[start:start + struct.calcsize(item_format) * length].cast(item_format)
+
+        self.ids = section("q", num_docs)
+        self.sorted_docs = section("I", num_docs)
+        self.trigram_keys = section("Q", num_trigrams)
+        self.posting_offsets = section("Q", num_trigrams + 1)
+        self.posting_docs = section("I", num_postings)
+        name_offsets = section("Q", num_docs + 1)
+        self.names = MappedNames(name_offsets, section("B", names_size))
+
+    def posting(self, trigram: str):
+        key = trigram_key(trigram)
+        i = bisect_left(self.trigram_keys, key)
+        if i == len(self.trigram_keys) or self.trigram_keys[i] != key:
+            return ()
+        return self.posting_docs[self.posting_offsets[i]:self.posting_offsets[i + 1]]
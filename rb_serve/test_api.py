@@ -0,0 +1,40 @@
+import sqlite3
+
+import pytest
+from flask import Flask
+
+from api import api
+from database import ConnectionPool
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = tmp_path / "corporate.sqlite"
+    db_conn = sqlite3.connect(path)
+    db_conn.execute(
+        "CREATE TABLE companies (id INTEGER PRIMARY KEY, state TEXT, reference_id TEXT, registration_authority TEXT, "
+        "is_active INTEGER, name TEXT, type TEXT, address TEXT, purpose TEXT, capital REAL, currency TEXT)"
+    )
+    db_conn.executemany(
+        "INSERT INTO companies (id, name, type, is_active) VALUES (?, ?, ?, ?)",
+        [(id, f"Company {id}", "GmbH" if id % 2 else "AG", 1) for id in range(1, 8)],
+    )
+    db_conn.commit()
+    db_conn.close()
+
+    app = Flask(__name__)
+    app.db_pool = ConnectionPool(str(path))
+    app.register_blueprint(api)
+    return app.test_client()
+
+
+def test_filtered_pages(client):
+    ids = []
+    url = "/api/companies?type=GmbH&limit=2&name=ignored"
+    while url is not None:
+        response = client.get(url)
+        assert response.status_code == 200
+        ids += [company["id"] for company in response.json["data"]]
+        url = response.json["next"]
+        assert url is None or ("type=GmbH" in url and "name=" not in url)
+    assert ids == [1, 3, 5, 7]
@@ -5,6 +5,9 @@ CREATE TABLE events (
     event_type TEXT,
     status TEXT,
     information TEXT,
+    -- Set instead of information for texts compressed by the producer, rb_parser decompresses them
+    information_compressed BLOB,
+    dictionary_id TEXT,
     FOREIGN KEY (company_id) REFERENCES companies(id)
 );
 
@@ -21,7 +24,8 @@ INSERT INTO events
     SELECT
         c.id,
         date(substr(e.event_date, -4) || '-' || substr(e.event_date, 4, 2)  || '-' || substr(e.event_date, 1, 2)) as ed,
-        e.event_type, e.status, e.information
+        e.event_type, e.status, e.information,
+        nullif(e.information_compressed, X''), nullif(e.dictionary_id, '')
     FROM 
         "corporate-events" e,
         companies c
@@ -0,0 +1,65 @@
+-- Full-text indexes over company names, purposes and addresses and over person names.
+-- They are external content tables, i.e. they only store the index and read the texts from companies/persons.
+-- The triggers keep them in sync while rb_parser.py writes the parsed companies and persons.
+DROP TABLE IF EXISTS companies_fts;
+CREATE VIRTUAL TABLE companies_fts USING fts5(
+    name,
+    purpose,
+    address,
+    content = 'companies',
+    content_rowid = 'id',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+DROP TRIGGER IF EXISTS companies_fts_insert;
+CREATE TRIGGER companies_fts_insert AFTER INSERT ON companies BEGIN
+    INSERT INTO companies_fts (rowid, name, purpose, address) VALUES (new.id, new.name, new.purpose, new.address);
+END;
+
+DROP TRIGGER IF EXISTS companies_fts_delete;
+CREATE TRIGGER companies_fts_delete AFTER DELETE ON companies BEGIN
+    INSERT INTO companies_fts (companies_fts, rowid, name, purpose, address)
+        VALUES ('delete', old.id, old.name, old.purpose, old.address);
+END;
+
+DROP TRIGGER IF EXISTS companies_fts_update;
+CREATE TRIGGER companies_fts_update AFTER UPDATE OF name, purpose, address ON companies BEGIN
+    INSERT INTO companies_fts (companies_fts, rowid, name, purpose, address)
+        VALUES ('delete', old.id, old.name, old.purpose, old.address);
+    INSERT INTO companies_fts (rowid, name, purpose, address) VALUES (new.id, new.name, new.purpose, new.address);
+END;
+
+INSERT INTO companies_fts (companies_fts) VALUES ('rebuild');
+
+
+DROP TABLE IF EXISTS persons_fts;
+CREATE VIRTUAL TABLE persons_fts USING fts5(
+    first_name,
+    last_name,
+    birth_location,
+    content = 'persons',
+    content_rowid = 'id',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+DROP TRIGGER IF EXISTS persons_fts_insert;
+CREATE TRIGGER persons_fts_insert AFTER INSERT ON persons BEGIN
+    INSERT INTO persons_fts (rowid, first_name, last_name, birth_location)
+        VALUES (new.id, new.first_name, new.last_name, new.birth_location);
+END;
+
+DROP TRIGGER IF EXISTS persons_fts_delete;
+CREATE TRIGGER persons_fts_delete AFTER DELETE ON persons BEGIN
+    INSERT INTO persons_fts (persons_fts, rowid, first_name, last_name, birth_location)
+        VALUES ('delete', old.id, old.first_name, old.last_name, old.birth_location);
+END;
+
+DROP TRIGGER IF EXISTS persons_fts_update;
+CREATE TRIGGER persons_fts_update AFTER UPDATE OF first_name, last_name, birth_location ON persons BEGIN
+    INSERT INTO persons_fts (persons_fts, rowid, first_name, last_name, birth_location)
+        VALUES ('delete', old.id, old.first_name, old.last_name, old.birth_location);
+    INSERT INTO persons_fts (rowid, first_name, last_name, birth_location)
+        VALUES (new.id, new.first_name, new.last_name, new.birth_location);
+END;
+
+INSERT INTO persons_fts (persons_fts) VALUES ('rebuild');
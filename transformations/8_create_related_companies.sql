@@ -0,0 +1,32 @@
+-- Companies related by their active persons, i.e. the co-director network shown on the company pages.
+-- Every pair of companies sharing an active person is stored in both directions, so a company's related companies
+-- are a single primary key range lookup. The table is rebuilt by rb_person_deduplicator.py after persons were merged.
+CREATE INDEX IF NOT EXISTS corporate_roles_company_id ON corporate_roles(company_id, active, person_id);
+CREATE INDEX IF NOT EXISTS corporate_roles_person_id ON corporate_roles(person_id, active, company_id);
+
+DROP TABLE IF EXISTS related_companies;
+CREATE TABLE related_companies (
+    company_id INTEGER,
+    related_id INTEGER,
+    shared_persons INTEGER,
+    -- The persons in common with their roles in the related company
+    persons_in_common TEXT,
+    PRIMARY KEY (company_id, related_id),
+    FOREIGN KEY (company_id) REFERENCES companies(id),
+    FOREIGN KEY (related_id) REFERENCES companies(id)
+) WITHOUT ROWID;
+
+INSERT INTO related_companies
+    SELECT
+        own.company_id,
+        related.company_id,
+        COUNT(DISTINCT p.id),
+        GROUP_CONCAT(p.last_name || ', ' || p.first_name || ' (' || related.role || ')', ', ')
+    FROM
+        (SELECT DISTINCT company_id, person_id FROM corporate_roles WHERE active = 1) own
+        JOIN corporate_roles related ON related.person_id = own.person_id
+        JOIN persons p ON p.id = own.person_id
+    WHERE
+            related.active = 1
+        AND related.company_id != own.company_id
+    GROUP BY own.company_id, related.company_id;